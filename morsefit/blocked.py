@@ -0,0 +1,202 @@
+"""Defines the out-of-core blocked evaluation of the residue and Jacobian
+
+For very large data sets, neither the flattened arrays of the interactions nor
+the dense :math:`N\\times{}M` Jacobian fit into memory. Here the configurations
+are processed in blocks of a given number of configurations, with the
+interactions of each block read from the arrays of the configuration set,
+which are normally memory mapped from the cache. The products with the
+Jacobian are accumulated block by block, so that the peak memory is bounded by
+the block size rather than the size of the data set.
+
+"""
+
+import numpy as np
+
+from .morse import morse_fused, morse_energy
+from .residue import get_pot_of_pair
+
+
+class BlockedEvaluator(object):
+
+    """Evaluates the residue and the Jacobian products block by block
+
+    .. py:attribute:: conf_set
+
+      The configuration set, whose arrays are normally memory mapped.
+
+    .. py:attribute:: n_pot
+
+      The number of Morse potentials.
+
+    .. py:attribute:: block_size
+
+      The number of configurations in each block.
+
+    .. py:attribute:: pot_of_pair
+
+      The index of the Morse potential for each pair type of the set.
+
+    """
+
+    __slots__ = [
+            "conf_set",
+            "n_pot",
+            "block_size",
+            "pot_of_pair",
+            "_params",
+            "_out"
+            ]
+
+    def __init__(self, conf_set, morse, block_size):
+
+        """Initializes the evaluator
+
+        :param conf_set: The :py:class:`ConfigurationSet` with the
+          interactions calculated.
+        :param morse: The list of initial guesses for the Morse potential.
+        :param int block_size: The number of configurations in each block.
+
+        """
+
+        self.conf_set = conf_set
+        self.n_pot = len(morse)
+        self.block_size = max(int(block_size), 1)
+        self.pot_of_pair = get_pot_of_pair(morse, conf_set)
+
+        # Buffers for the largest block.
+        max_inter = max([0] + [
+            i[3] - i[2] for i in self.blocks()
+            ])
+        self._params = np.empty((3, max_inter), dtype=np.float64)
+        self._out = np.empty((4, max_inter), dtype=np.float64)
+
+    def blocks(self):
+
+        """Iterates over the blocks
+
+        :return: A generator of tuples of the begin and end index of the
+          configurations and the begin and end index of the interactions in
+          each block.
+
+        """
+
+        offsets = self.conf_set.inter_offsets
+        m = len(self.conf_set)
+        for conf_begin in xrange(0, m, self.block_size):
+            conf_end = min(conf_begin + self.block_size, m)
+            yield (
+                    conf_begin, conf_end,
+                    int(offsets[conf_begin]), int(offsets[conf_end])
+                    )
+            continue
+
+    def eval_block(self, mp, block, with_jacobi=True):
+
+        """Evaluates the residue and the Jacobian of a block
+
+        :param mp: The grand vector of Morse parameters.
+        :param block: The block, as given by :py:meth:`blocks`.
+        :param with_jacobi: If the Jacobian of the block is needed.
+        :return: The residues of the configurations in the block, and the
+          :math:`N\\times{}B` Jacobian of the block, which is None when it is
+          not requested.
+
+        """
+
+        conf_begin, conf_end, inter_begin, inter_end = block
+        conf_set = self.conf_set
+        n_confs = conf_end - conf_begin
+        n_inter = inter_end - inter_begin
+
+        dists = np.asarray(conf_set.dists[inter_begin:inter_end])
+        pot_idx = self.pot_of_pair[conf_set.pair_codes[inter_begin:inter_end]]
+        conf_idx = np.repeat(
+                np.arange(n_confs),
+                np.diff(conf_set.inter_offsets[conf_begin:conf_end + 1])
+                )
+
+        mp_mat = np.reshape(mp, (-1, 3))
+        params = self._params[:, :n_inter]
+        for i in xrange(0, 3):
+            np.take(mp_mat[:, i], pot_idx, out=params[i])
+            continue
+        de, a, r0 = params
+
+        ab_initio_e = conf_set.ab_initio_e[conf_begin:conf_end]
+        if not with_jacobi:
+            energies = morse_energy(
+                    dists, de, a, r0, out=self._out[0, :n_inter]
+                    )
+            return np.bincount(
+                    conf_idx, weights=energies, minlength=n_confs
+                    ) - ab_initio_e, None
+
+        terms = morse_fused(dists, de, a, r0, out=self._out[:, :n_inter])
+        res = np.bincount(
+                conf_idx, weights=terms[0], minlength=n_confs
+                ) - ab_initio_e
+        jacobi_idx = pot_idx * n_confs + conf_idx
+        jac = np.empty((self.n_pot, 3, n_confs), dtype=np.float64)
+        for i_param in xrange(0, 3):
+            jac[:, i_param, :] = np.bincount(
+                    jacobi_idx, weights=terms[i_param + 1],
+                    minlength=self.n_pot * n_confs
+                    ).reshape((self.n_pot, n_confs))
+            continue
+
+        return res, jac.reshape((3 * self.n_pot, n_confs))
+
+    def residue(self, mp):
+
+        """Computes the residue vector of all the configurations"""
+
+        res = np.empty(len(self.conf_set), dtype=np.float64)
+        for block in self.blocks():
+            res[block[0]:block[1]] = self.eval_block(
+                    mp, block, with_jacobi=False
+                    )[0]
+            continue
+        return res
+
+    def normal_equations(self, mp):
+
+        """Computes the residue square and the normal equations
+
+        The :math:`N\\times{}N` matrix :math:`J J^T` and the vector
+        :math:`J r` are accumulated block by block, so that the memory is
+        bounded by the number of parameters and the block size. The results
+        can be used with
+        :py:func:`morsefit.solvers.fit_normal_equations`.
+
+        """
+
+        n = 3 * self.n_pot
+        norm_sq = 0.0
+        jtj = np.zeros((n, n), dtype=np.float64)
+        jtr = np.zeros(n, dtype=np.float64)
+        for block in self.blocks():
+            res, jac = self.eval_block(mp, block)
+            norm_sq += res.dot(res)
+            jtj += jac.dot(jac.T)
+            jtr += jac.dot(res)
+            continue
+        return norm_sq, jtj, jtr
+
+    def fun_grad(self, mp):
+
+        """Computes the residue square and its gradient
+
+        The dense Jacobian is never formed, with the gradient
+        :math:`2 J r` accumulated block by block. The result can be used with
+        the ``jac=True`` option of :py:func:`scipy.optimize.minimize`.
+
+        """
+
+        norm_sq = 0.0
+        grad = np.zeros(3 * self.n_pot, dtype=np.float64)
+        for block in self.blocks():
+            res, jac = self.eval_block(mp, block)
+            norm_sq += res.dot(res)
+            grad += 2.0 * jac.dot(res)
+            continue
+        return norm_sq, grad
@@ -0,0 +1,171 @@
+"""Defines the persistent cache of parsed configurations
+
+Parsing the configuration files and resolving the interactions can take a lot
+of time for large data sets, while they stay the same for runs with different
+options for the optimization. So the configuration set can be cached on disk,
+in the format of :py:meth:`ConfigurationSet.save`, so that the arrays can be
+memory mapped by later runs.
+
+Each cache entry is a sub-directory of the cache directory named after the
+list of configuration files and the cut-off. The path, the modification time
+and the size of each of the files are recorded in the entry, and the entry is
+rebuilt automatically when any of them no longer matches.
+
+The entries are built from chunks of the files read one at a time and appended
+to the arrays on disk, so that the data set never needs to fit in the memory
+as a whole.
+
+"""
+
+import os
+import shutil
+import hashlib
+import json
+import tempfile
+
+from .configuration import ConfigurationSet, ConfigurationSetWriter, load_meta
+
+
+# The default number of files read at a time when building a cache entry
+CACHE_CHUNK_SIZE = 1000
+
+
+def gen_cache_key(file_names, cut_off):
+
+    """Generates the key for the cache of configuration files
+
+    :param file_names: The list of names of the configuration files.
+    :param cut_off: The cut-off for the interactions.
+    :return: A dictionary of the absolute paths, the modification times, the
+      sizes of the files, and the cut-off.
+
+    """
+
+    files = []
+    for i in file_names:
+        stat = os.stat(i)
+        files.append([os.path.abspath(i), stat.st_mtime, stat.st_size])
+        continue
+
+    return {
+            'files': files,
+            'cut_off': cut_off
+            }
+
+
+def get_entry_name(cache_dir, file_names, cut_off):
+
+    """Gets the directory name of the cache entry for the given files
+
+    The name only depends on the paths of the files and the cut-off, so that
+    outdated entries are overwritten rather than accumulated.
+
+    """
+
+    digest = hashlib.sha1(json.dumps([
+        [ os.path.abspath(i) for i in file_names ], cut_off
+        ])).hexdigest()
+
+    return os.path.join(cache_dir, digest)
+
+
+def load_cache(cache_dir, file_names, cut_off, mmap=True):
+
+    """Loads the cached configuration set for the given files
+
+    :param cache_dir: The cache directory.
+    :param file_names: The list of names of the configuration files.
+    :param cut_off: The cut-off for the interactions.
+    :param mmap: If the arrays are going to be memory mapped.
+    :return: The cached configuration set, or None if it is not found or it is
+      outdated.
+
+    """
+
+    entry_name = get_entry_name(cache_dir, file_names, cut_off)
+
+    try:
+        meta = load_meta(entry_name)
+    except (IOError, ValueError):
+        return None
+
+    try:
+        key = gen_cache_key(file_names, cut_off)
+    except OSError:
+        return None
+    if meta['extra'].get('cache_key') != key:
+        return None
+
+    try:
+        return ConfigurationSet.load(entry_name, mmap=mmap)
+    except (IOError, ValueError):
+        return None
+
+
+def build_cache(cache_dir, file_names, cut_off, reader,
+                chunk_size=CACHE_CHUNK_SIZE):
+
+    """Builds the cache entry for the given files
+
+    The files are read by chunks, which are appended to the entry on disk one
+    after another, so only a chunk needs to be held in memory at a time. The
+    entry is written into a temporary directory first and then moved into
+    place, so that an interrupted run never leaves a corrupt entry.
+
+    :param cache_dir: The cache directory, which is created if needed.
+    :param file_names: The list of names of the configuration files.
+    :param cut_off: The cut-off for the interactions.
+    :param reader: The function to read the configuration set from a chunk of
+      the files and the cut-off.
+    :param int chunk_size: The number of files to be read at a time.
+
+    """
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    entry_name = get_entry_name(cache_dir, file_names, cut_off)
+    key = gen_cache_key(file_names, cut_off)
+
+    tmp_name = tempfile.mkdtemp(dir=cache_dir)
+    writer = ConfigurationSetWriter(tmp_name)
+    for i in xrange(0, len(file_names), chunk_size):
+        writer.append(reader(file_names[i:i + chunk_size], cut_off))
+        continue
+    writer.close(extra_meta={'cache_key': key})
+
+    if os.path.isdir(entry_name):
+        shutil.rmtree(entry_name)
+    os.rename(tmp_name, entry_name)
+
+    return None
+
+
+def read_cached_set(file_names, cut_off, cache_dir, reader):
+
+    """Reads the configuration set through the cache
+
+    :param file_names: The list of names of the configuration files.
+    :param cut_off: The cut-off for the interactions.
+    :param cache_dir: The cache directory, None for no caching.
+    :param reader: The function to read the configuration set from the files
+      and the cut-off. When the cache is missed, it is invoked on chunks of
+      the files by :py:func:`build_cache`.
+    :return: The configuration set, and whether the cache has been hit. When
+      the cache is used, the returned set is always memory mapped from the
+      cache, even when it has just been built.
+
+    """
+
+    if cache_dir is None:
+        return reader(file_names, cut_off), False
+
+    conf_set = load_cache(cache_dir, file_names, cut_off)
+    if conf_set is not None:
+        return conf_set, True
+
+    build_cache(cache_dir, file_names, cut_off, reader)
+
+    return ConfigurationSet.load(
+            get_entry_name(cache_dir, file_names, cut_off)
+            ), False
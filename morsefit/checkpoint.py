@@ -0,0 +1,92 @@
+"""Defines the checkpoints of long optimization runs
+
+Fits on large data sets can run for hours, and a killed job would lose all the
+progress. So the state of the optimization can be written into a checkpoint
+file periodically, which contains the vector of parameters, the number of
+trunks of steps that have been finished, the number of function calls so far,
+the method, and a fingerprint of the data set, so that a later run can resume
+from it.
+
+The checkpoint is a JSON file, which is always written into a temporary file
+first and then renamed into place, so that the checkpoint on disk is always
+complete even when the job is killed while writing it.
+
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+from .cache import gen_cache_key
+
+
+def dataset_fingerprint(file_names, cut_off):
+
+    """Computes the fingerprint of a data set
+
+    The fingerprint is based on the absolute paths, the modification times and
+    the sizes of the configuration files, as well as the cut-off, so that it
+    can be computed without reading the files.
+
+    :param file_names: The list of names of the configuration files.
+    :param cut_off: The cut-off for the interactions.
+    :return: The hexadecimal digest of the fingerprint.
+
+    """
+
+    return hashlib.sha1(json.dumps(
+        gen_cache_key(file_names, cut_off), sort_keys=True
+        )).hexdigest()
+
+
+def save_checkpoint(file_name, param, **state):
+
+    """Writes a checkpoint atomically
+
+    :param file_name: The name of the checkpoint file.
+    :param param: The current vector of parameters.
+    :param state: The other fields of the state of the optimization, which
+      should be serializable by JSON.
+
+    """
+
+    dir_name = os.path.dirname(os.path.abspath(file_name))
+    state['param'] = [ float(i) for i in param ]
+
+    fd, tmp_name = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(state, tmp_file, indent=2, sort_keys=True)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.rename(tmp_name, file_name)
+    except:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    return None
+
+
+def load_checkpoint(file_name):
+
+    """Reads a checkpoint
+
+    :param file_name: The name of the checkpoint file.
+    :return: The dictionary of the state, with the parameters under the key
+      ``param`` as a numpy array, or None if the file does not exist or is
+      corrupt.
+
+    """
+
+    try:
+        with open(file_name) as checkpoint_file:
+            state = json.load(checkpoint_file)
+    except (IOError, ValueError):
+        return None
+
+    state['param'] = np.array(state['param'], dtype=np.float64)
+    return state
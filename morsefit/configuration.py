@@ -1,9 +1,14 @@
 """Defines the class for an atomic configuration"""
 
+import os
+import sys
+import json
+import struct
 import itertools
 
 import numpy as np
-from numpy import linalg
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
 
 
 class Configuration(object):
@@ -41,6 +46,11 @@ class Configuration(object):
       A list of interacting atomic pairs in the configuration. Given as a triple
       and atomic symbols and the distance.
 
+    .. py:attribute:: cell
+
+      The :math:`3\times{}3` array of the lattice vectors as rows for periodic
+      configurations, or None for isolated clusters.
+
     """
 
     __slots__ = [
@@ -49,7 +59,8 @@ class Configuration(object):
             "tag",
             "ab_initio_e",
             "cut_off",
-            "interactions"
+            "interactions",
+            "cell"
             ]
 
     def __init__(self, file_name, tag, ab_e):
@@ -72,6 +83,7 @@ class Configuration(object):
         self.molecules = []
         self.cut_off = None
         self.interactions = []
+        self.cell = None
 
     def add_molecule(self, mol):
 
@@ -89,6 +101,14 @@ class Configuration(object):
 
         """Calculate the interactions from the molecules that has been added
 
+        Without a cut-off, the distances between the atoms of each pair of
+        molecules are computed block by block. When a cut-off is given, the
+        pairs are found by a KD-tree neighbour search so that only the pairs
+        within the cut-off are ever formed. Both give the same interactions in
+        the same order. For periodic configurations, the minimum-image pairs
+        within the cut-off are found by linked cells, and the cut-off is
+        required.
+
         .. warning::
 
           This method has to be invoked after the :py:meth:`add_molecule` has
@@ -101,18 +121,934 @@ class Configuration(object):
 
         """
 
-        for mol1, mol2 in itertools.combinations(self.molecules, 2):
-            for atm1 in mol1:
-                for atm2 in mol2:
-                    dist = linalg.norm(atm1[1] - atm2[1])
-                    if cut_off and dist > cut_off:
-                        continue
-                    else:
-                        self.interactions.append(
-                                ((atm1[0], atm2[0]), dist) )
-                        continue
+        symbs = [ atm[0] for mol in self.molecules for atm in mol ]
+        coords = [
+                np.array([ atm[1] for atm in mol ],
+                         dtype=np.float64).reshape((-1, 3))
+                for mol in self.molecules ]
+
+        try:
+            first, second, dists = find_pairs(coords, cut_off, self.cell)
+        except ValueError as exc:
+            print "In configuration %s: %s" % (self.file_name, exc)
+            sys.exit(1)
+
+        self.interactions.extend(
+                ((symbs[i], symbs[j]), dist)
+                for i, j, dist in zip(first, second, dists)
+                )
 
         self.cut_off = cut_off
 
         return len(self.interactions)
 
+
+class ConfigurationSet(object):
+
+    """A compact array-backed storage of a set of configurations
+
+    Instead of lists of tuples for each atom and each interaction, all the
+    information about all the configurations in a data set is stored in a few
+    contiguous arrays here. The element symbols and the pairs of element
+    symbols are interned, with integral codes stored in the arrays. The
+    configurations and the molecules are given by offsets into the arrays of
+    atoms and interactions, which are stored in the order of the
+    configurations.
+
+    The set can be indexed and iterated over to get light-weight
+    :py:class:`ConfigurationView` objects for each of the configurations.
+
+    .. py:attribute:: coords
+
+      The :math:`n\times{}3` array of Cartesian coordinates of all the atoms.
+
+    .. py:attribute:: elem_codes
+
+      The codes of the element symbols of all the atoms, as indices into
+      :py:attr:`elements`.
+
+    .. py:attribute:: elements
+
+      The list of the element symbols.
+
+    .. py:attribute:: mol_offsets
+
+      The offsets of the molecules into the array of atoms, with the atoms of
+      molecule ``i`` being ``mol_offsets[i]`` up to ``mol_offsets[i + 1]``.
+
+    .. py:attribute:: conf_offsets
+
+      The offsets of the configurations into the array of molecules.
+
+    .. py:attribute:: dists
+
+      The distances of all the interactions.
+
+    .. py:attribute:: pair_codes
+
+      The codes of the pairs of element symbols of all the interactions, as
+      indices into :py:attr:`pair_types`.
+
+    .. py:attribute:: pair_types
+
+      The list of sorted pairs of element symbols.
+
+    .. py:attribute:: inter_offsets
+
+      The offsets of the configurations into the array of interactions.
+
+    .. py:attribute:: ab_initio_e
+
+      The array of ab-initio energies.
+
+    .. py:attribute:: cells
+
+      The :math:`m\times{}3\times{}3` array of the lattice vectors of the
+      configurations, filled with NaN for the non-periodic ones.
+
+    .. py:attribute:: file_names
+
+      The list of file names of the configurations.
+
+    .. py:attribute:: tags
+
+      The list of tags of the configurations.
+
+    .. py:attribute:: cut_off
+
+      The cut-off for the interactions.
+
+    """
+
+    __slots__ = [
+            "coords",
+            "elem_codes",
+            "elements",
+            "mol_offsets",
+            "conf_offsets",
+            "dists",
+            "pair_codes",
+            "pair_types",
+            "inter_offsets",
+            "ab_initio_e",
+            "cells",
+            "file_names",
+            "tags",
+            "cut_off"
+            ]
+
+    def __init__(self):
+
+        """Initializes an empty set of configurations
+
+        Normally the sets are created by :py:meth:`from_configurations`.
+
+        """
+
+        self.coords = np.empty((0, 3), dtype=np.float64)
+        self.elem_codes = np.empty(0, dtype=np.int32)
+        self.elements = []
+        self.mol_offsets = np.zeros(1, dtype=np.int64)
+        self.conf_offsets = np.zeros(1, dtype=np.int64)
+        self.dists = np.empty(0, dtype=np.float64)
+        self.pair_codes = np.empty(0, dtype=np.int32)
+        self.pair_types = []
+        self.inter_offsets = np.zeros(1, dtype=np.int64)
+        self.ab_initio_e = np.empty(0, dtype=np.float64)
+        self.cells = np.empty((0, 3, 3), dtype=np.float64)
+        self.file_names = []
+        self.tags = []
+        self.cut_off = None
+
+    @classmethod
+    def from_configurations(cls, confs):
+
+        """Builds the set from an iterable of configurations
+
+        The configurations are consumed one after another, so a generator can
+        be given to avoid having all the :py:class:`Configuration` objects in
+        memory at the same time. The interactions that have been calculated
+        for the configurations are carried over as well.
+
+        :param confs: An iterable of :py:class:`Configuration` objects.
+
+        """
+
+        conf_set = cls()
+        elem_table = {}
+        pair_table = {}
+
+        coords = []
+        elem_codes = []
+        mol_sizes = []
+        conf_sizes = []
+        dists = []
+        pair_codes = []
+        inter_sizes = []
+        ab_initio_e = []
+        cells = []
+
+        for conf in confs:
+            for mol in conf.molecules:
+                for symb, coord in mol:
+                    coords.append(coord)
+                    elem_codes.append(
+                            _intern(elem_table, conf_set.elements, symb)
+                            )
+                    continue
+                mol_sizes.append(len(mol))
+                continue
+            conf_sizes.append(len(conf.molecules))
+            for elem_pair, dist in conf.interactions:
+                dists.append(dist)
+                pair_codes.append(_intern(
+                    pair_table, conf_set.pair_types, tuple(sorted(elem_pair))
+                    ))
+                continue
+            inter_sizes.append(len(conf.interactions))
+            ab_initio_e.append(conf.ab_initio_e)
+            cells.append(conf.cell if conf.cell is not None else NO_CELL)
+            conf_set.file_names.append(conf.file_name)
+            conf_set.tags.append(conf.tag)
+            conf_set.cut_off = conf.cut_off
+            continue
+
+        conf_set.coords = np.array(
+                coords, dtype=np.float64
+                ).reshape((-1, 3))
+        conf_set.elem_codes = np.array(elem_codes, dtype=np.int32)
+        conf_set.mol_offsets = _offsets(mol_sizes)
+        conf_set.conf_offsets = _offsets(conf_sizes)
+        conf_set.dists = np.array(dists, dtype=np.float64)
+        conf_set.pair_codes = np.array(pair_codes, dtype=np.int32)
+        conf_set.inter_offsets = _offsets(inter_sizes)
+        conf_set.ab_initio_e = np.array(ab_initio_e, dtype=np.float64)
+        conf_set.cells = np.array(cells, dtype=np.float64).reshape((-1, 3, 3))
+
+        return conf_set
+
+    @classmethod
+    def concatenate(cls, conf_sets):
+
+        """Concatenates several configuration sets into one
+
+        The configurations are kept in the order of the given sets, with the
+        element symbols and the pairs re-interned for the combined set. All
+        the sets should have the interactions calculated with the same
+        cut-off.
+
+        :param conf_sets: The iterable of configuration sets.
+
+        """
+
+        result = cls()
+        parts = dict((i, [ getattr(result, i) ]) for i in _ARRAY_FIELDS)
+        merger = _SetMerger(result)
+
+        for conf_set in conf_sets:
+            for k, v in merger.merge(conf_set).items():
+                parts[k].append(v)
+                continue
+            continue
+
+        for i in _ARRAY_FIELDS:
+            setattr(result, i, np.concatenate(parts[i]).astype(
+                getattr(result, i).dtype, copy=False
+                ))
+            continue
+
+        if len(result.cells) != len(result.ab_initio_e):
+            raise ValueError('Inconsistent cells in the concatenated sets')
+
+        return result
+
+    def __getstate__(self):
+
+        """Gets the state for pickling, just the arrays and the lists"""
+
+        return dict((i, getattr(self, i)) for i in self.__slots__)
+
+    def __setstate__(self, state):
+
+        """Sets the state from unpickling"""
+
+        for k, v in state.items():
+            setattr(self, k, v)
+            continue
+        return None
+
+    def save(self, dir_name, extra_meta=None):
+
+        """Saves the set into a directory
+
+        Each of the arrays is saved as a separate ``.npy`` file, so that they
+        can be memory mapped when loaded, and the rest of the information is
+        saved in a JSON file ``meta.json``. The directory is created if it does
+        not exist.
+
+        :param dir_name: The name of the directory.
+        :param extra_meta: A dictionary of additional information to be saved
+          along with the meta data, it can be read by :py:func:`load_meta`.
+
+        """
+
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+
+        for i in _ARRAY_FIELDS:
+            np.save(os.path.join(dir_name, i + '.npy'), getattr(self, i))
+            continue
+
+        self.save_meta(dir_name, extra_meta)
+        return None
+
+    def save_meta(self, dir_name, extra_meta=None):
+
+        """Saves the information other than the arrays into a directory
+
+        :param dir_name: The name of the existing directory.
+        :param extra_meta: The additional information, as in :py:meth:`save`.
+
+        """
+
+        meta = {
+                'elements': self.elements,
+                'pair_types': self.pair_types,
+                'file_names': self.file_names,
+                'tags': self.tags,
+                'cut_off': self.cut_off,
+                'extra': extra_meta if extra_meta is not None else {}
+                }
+        with open(os.path.join(dir_name, 'meta.json'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        return None
+
+    @classmethod
+    def load(cls, dir_name, mmap=True):
+
+        """Loads a set saved by :py:meth:`save`
+
+        :param dir_name: The name of the directory.
+        :param mmap: If the arrays are going to be memory mapped read-only,
+          rather than read into memory.
+
+        """
+
+        meta = load_meta(dir_name)
+        conf_set = cls()
+        for i in _ARRAY_FIELDS:
+            file_name = os.path.join(dir_name, i + '.npy')
+            # The sets saved before the support of cells are not periodic.
+            if i == 'cells' and not os.path.exists(file_name):
+                conf_set.cells = np.tile(NO_CELL, (len(conf_set), 1, 1))
+                continue
+            setattr(conf_set, i, np.load(
+                file_name, mmap_mode='r' if mmap else None
+                ))
+            continue
+
+        conf_set.elements = [ _to_str(i) for i in meta['elements'] ]
+        conf_set.pair_types = [
+                tuple(_to_str(j) for j in i) for i in meta['pair_types']
+                ]
+        conf_set.file_names = [ _to_str(i) for i in meta['file_names'] ]
+        conf_set.tags = [ _to_str(i) for i in meta['tags'] ]
+        conf_set.cut_off = meta['cut_off']
+
+        return conf_set
+
+    def __len__(self):
+
+        """Gets the number of configurations"""
+
+        return len(self.ab_initio_e)
+
+    def __getitem__(self, idx):
+
+        """Gets the view of a configuration"""
+
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('Configuration index out of range')
+        return ConfigurationView(self, idx)
+
+    def __iter__(self):
+
+        """Iterates over the views of the configurations"""
+
+        for i in xrange(0, len(self)):
+            yield ConfigurationView(self, i)
+            continue
+
+    def conf_index(self):
+
+        """Gets the index of the owning configuration of each interaction"""
+
+        return np.repeat(
+                np.arange(len(self)), np.diff(self.inter_offsets)
+                )
+
+    def mol_coords(self, idx):
+
+        """Gets the coordinate arrays of the molecules in a configuration
+
+        :param int idx: The index of the configuration.
+        :return: A list of views into :py:attr:`coords` for each molecule.
+
+        """
+
+        mol_begin, mol_end = self.conf_offsets[idx:idx + 2]
+        return [
+                self.coords[self.mol_offsets[i]:self.mol_offsets[i + 1]]
+                for i in xrange(mol_begin, mol_end)
+                ]
+
+    def calc_interactions(self, cut_off):
+
+        """Calculates the interactions of all the configurations
+
+        The interactions are calculated directly from the coordinate arrays in
+        the same way as :py:meth:`Configuration.calc_interactions`, and any
+        interactions that were present are replaced.
+
+        :param cut_off: The cut-off for the interactions, ``None`` for no
+          cut-off.
+        :return: The total number of interactions.
+
+        """
+
+        n_elems = len(self.elements)
+        periodic = ~np.isnan(self.cells).any(axis=(1, 2))
+
+        dists = [ np.empty(0, dtype=np.float64) ]
+        elem_pairs = [ np.empty(0, dtype=np.int64) ]
+        inter_sizes = []
+        for i_conf in xrange(0, len(self)):
+            atm_base = self.mol_offsets[self.conf_offsets[i_conf]]
+            try:
+                first, second, i_dists = find_pairs(
+                        self.mol_coords(i_conf), cut_off,
+                        self.cells[i_conf] if periodic[i_conf] else None
+                        )
+            except ValueError as exc:
+                print "In configuration %s: %s" % (
+                        self.file_names[i_conf], exc
+                        )
+                sys.exit(1)
+            dists.append(i_dists)
+            elem_pairs.append(
+                    self.elem_codes[first + atm_base].astype(np.int64)
+                    * n_elems + self.elem_codes[second + atm_base]
+                    )
+            inter_sizes.append(len(i_dists))
+            continue
+
+        # Intern the pairs of element symbols that actually appear.
+        elem_pairs, elem_pair_codes = np.unique(
+                np.concatenate(elem_pairs), return_inverse=True
+                )
+        pair_table = {}
+        self.pair_types = []
+        pair_lookup = np.array([
+            _intern(pair_table, self.pair_types, tuple(sorted((
+                self.elements[i // n_elems], self.elements[i % n_elems]
+                ))))
+            for i in elem_pairs ], dtype=np.int32)
+
+        self.dists = np.concatenate(dists)
+        self.pair_codes = pair_lookup[elem_pair_codes].astype(np.int32)
+        self.inter_offsets = _offsets(inter_sizes)
+        self.cut_off = cut_off
+
+        return len(self.dists)
+
+
+class ConfigurationSetWriter(object):
+
+    """Writes a configuration set into a directory part by part
+
+    The sets appended are concatenated on disk in the format of
+    :py:meth:`ConfigurationSet.save`, in the same way as
+    :py:meth:`ConfigurationSet.concatenate`, so that a set larger than the
+    memory can be built from parts read one at a time. The arrays are written
+    after a header of fixed size, which is filled in with their final shapes
+    when the writer is closed.
+
+    """
+
+    __slots__ = [
+            "dir_name",
+            "conf_set",
+            "merger",
+            "files",
+            "lengths"
+            ]
+
+    def __init__(self, dir_name):
+
+        """Initializes the writer into a directory
+
+        :param dir_name: The name of the directory, which is created if it
+          does not exist.
+
+        """
+
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+
+        self.dir_name = dir_name
+        # The set holding everything but the arrays
+        self.conf_set = ConfigurationSet()
+        self.merger = _SetMerger(self.conf_set)
+        self.files = {}
+        self.lengths = {}
+
+        for i in _ARRAY_FIELDS:
+            self.files[i] = open(os.path.join(dir_name, i + '.npy'), 'wb')
+            self.files[i].write('\0' * _NPY_HEADER_SIZE)
+            self.lengths[i] = 0
+            self._write(i, getattr(self.conf_set, i))
+            continue
+
+    def append(self, conf_set):
+
+        """Appends a configuration set to the end"""
+
+        for k, v in self.merger.merge(conf_set).items():
+            self._write(k, v)
+            continue
+        return None
+
+    def close(self, extra_meta=None):
+
+        """Finishes the arrays and writes the meta data
+
+        :param extra_meta: A dictionary of additional information to be saved
+          along with the meta data, as in :py:meth:`ConfigurationSet.save`.
+
+        """
+
+        for i in _ARRAY_FIELDS:
+            template = getattr(self.conf_set, i)
+            header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+                    np.lib.format.dtype_to_descr(template.dtype),
+                    (self.lengths[i], ) + template.shape[1:]
+                    )
+            prefix = np.lib.format.magic(1, 0)
+            header = header.ljust(
+                    _NPY_HEADER_SIZE - len(prefix) - 3
+                    ) + '\n'
+            out_file = self.files[i]
+            out_file.seek(0)
+            out_file.write(
+                    prefix + struct.pack('<H', len(header)) + header
+                    )
+            out_file.close()
+            continue
+
+        self.conf_set.save_meta(self.dir_name, extra_meta)
+        return None
+
+    def _write(self, field, values):
+
+        """Writes the values of an array field to the end of its file"""
+
+        values = np.ascontiguousarray(
+                values, dtype=getattr(self.conf_set, field).dtype
+                )
+        self.files[field].write(values.tostring())
+        self.lengths[field] += len(values)
+        return None
+
+
+class ConfigurationView(object):
+
+    """A light-weight view of a configuration in a configuration set
+
+    It gives the same attributes as :py:class:`Configuration`, read from the
+    arrays of the configuration set. The :py:attr:`molecules` and
+    :py:attr:`interactions` are built when they are requested.
+
+    """
+
+    __slots__ = [
+            "conf_set",
+            "index"
+            ]
+
+    def __init__(self, conf_set, index):
+
+        """Initializes the view for a configuration in a set"""
+
+        self.conf_set = conf_set
+        self.index = index
+
+    @property
+    def file_name(self):
+        return self.conf_set.file_names[self.index]
+
+    @property
+    def tag(self):
+        return self.conf_set.tags[self.index]
+
+    @property
+    def ab_initio_e(self):
+        return self.conf_set.ab_initio_e[self.index]
+
+    @property
+    def cut_off(self):
+        return self.conf_set.cut_off
+
+    @property
+    def cell(self):
+        cell = self.conf_set.cells[self.index]
+        return None if np.isnan(cell).any() else cell
+
+    @property
+    def molecules(self):
+        conf_set = self.conf_set
+        mol_begin, mol_end = conf_set.conf_offsets[self.index:self.index + 2]
+        return [
+                [
+                    (conf_set.elements[conf_set.elem_codes[i]],
+                     conf_set.coords[i])
+                    for i in xrange(conf_set.mol_offsets[i_mol],
+                                    conf_set.mol_offsets[i_mol + 1]) ]
+                for i_mol in xrange(mol_begin, mol_end)
+                ]
+
+    @property
+    def interactions(self):
+        conf_set = self.conf_set
+        begin, end = conf_set.inter_offsets[self.index:self.index + 2]
+        return [
+                (conf_set.pair_types[code], dist)
+                for code, dist in zip(
+                    conf_set.pair_codes[begin:end], conf_set.dists[begin:end]
+                    )
+                ]
+
+
+# The array attributes of the configuration set, in the order of saving.
+_ARRAY_FIELDS = [
+        "coords",
+        "elem_codes",
+        "mol_offsets",
+        "conf_offsets",
+        "dists",
+        "pair_codes",
+        "inter_offsets",
+        "ab_initio_e",
+        "cells"
+        ]
+
+
+# The cell of the non-periodic configurations in the arrays of cells
+NO_CELL = np.empty((3, 3), dtype=np.float64)
+NO_CELL.fill(np.nan)
+
+
+# The size of the headers of the array files written by the
+# :py:class:`ConfigurationSetWriter`, enough for any shape.
+_NPY_HEADER_SIZE = 128
+
+
+class _SetMerger(object):
+
+    """Merges configuration sets one after another into a target set
+
+    The element symbols, the pairs, the file names and the tags are merged
+    into the target set directly, while the arrays are returned for the caller
+    to store, with the codes re-interned and the offsets shifted.
+
+    """
+
+    __slots__ = [
+            "target",
+            "elem_table",
+            "pair_table",
+            "atm_base",
+            "mol_base",
+            "inter_base"
+            ]
+
+    def __init__(self, target):
+
+        """Initializes the merger into an empty set"""
+
+        self.target = target
+        self.elem_table = {}
+        self.pair_table = {}
+        self.atm_base = 0
+        self.mol_base = 0
+        self.inter_base = 0
+
+    def merge(self, conf_set):
+
+        """Merges a set, with the dictionary of its new array parts returned"""
+
+        target = self.target
+        elem_map = np.array([
+            _intern(self.elem_table, target.elements, i)
+            for i in conf_set.elements ], dtype=np.int32)
+        pair_map = np.array([
+            _intern(self.pair_table, target.pair_types, i)
+            for i in conf_set.pair_types ], dtype=np.int32)
+
+        parts = {
+                'coords': conf_set.coords,
+                'elem_codes': elem_map[conf_set.elem_codes],
+                'mol_offsets': conf_set.mol_offsets[1:] + self.atm_base,
+                'conf_offsets': conf_set.conf_offsets[1:] + self.mol_base,
+                'dists': conf_set.dists,
+                'pair_codes': pair_map[conf_set.pair_codes],
+                'inter_offsets': conf_set.inter_offsets[1:] + self.inter_base,
+                'ab_initio_e': conf_set.ab_initio_e,
+                'cells': conf_set.cells
+                }
+
+        self.atm_base += len(conf_set.elem_codes)
+        self.mol_base += len(conf_set.mol_offsets) - 1
+        self.inter_base += len(conf_set.dists)
+
+        target.file_names.extend(conf_set.file_names)
+        target.tags.extend(conf_set.tags)
+        target.cut_off = conf_set.cut_off
+
+        return parts
+
+
+def load_meta(dir_name):
+
+    """Loads the meta data of a configuration set saved in a directory
+
+    :return: The dictionary of meta data, with the additional information given
+      at saving under the key ``extra``.
+
+    """
+
+    with open(os.path.join(dir_name, 'meta.json')) as meta_file:
+        return json.load(meta_file)
+
+
+def _to_str(value):
+
+    """Converts the unicode strings read from JSON to plain strings"""
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    else:
+        return value
+
+
+def _intern(table, values, value):
+
+    """Interns a value into a table and gets its integral code"""
+
+    try:
+        return table[value]
+    except KeyError:
+        code = len(values)
+        table[value] = code
+        values.append(value)
+        return code
+
+
+def _offsets(sizes):
+
+    """Gets the array of offsets from the sizes of consecutive segments"""
+
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+
+def find_pairs(coords, cut_off, cell=None):
+
+    """Finds the intermolecular atomic pairs in a configuration
+
+    Without a cut-off, the distances between the atoms of each pair of
+    molecules are computed as a whole block. With a cut-off, a KD-tree of all
+    the atoms in the configuration is used for finding the neighbours, so that
+    the pairs beyond the cut-off are never formed. For periodic
+    configurations, the minimum-image pairs within the cut-off are found by
+    linked cells. In all cases, the pairs are sorted by the first molecule,
+    the second molecule, the first atom and the second atom.
+
+    :param coords: The list of :math:`n\times{}3` arrays for the coordinates
+      of the atoms in each molecule.
+    :param cut_off: The cut-off, ``None`` or zero for no cut-off.
+    :param cell: The :math:`3\times{}3` array of the lattice vectors as rows,
+      None for non-periodic configurations.
+    :return: The arrays of the index of the first atom, the index of the second
+      atom, and their distances. The atoms are indexed in the concatenation of
+      all the molecules.
+    :raises ValueError: If the cut-off is not given or too large for the
+      cell of a periodic configuration.
+
+    """
+
+    if cell is not None:
+        if not cut_off:
+            raise ValueError('A cut-off is needed for periodic configurations')
+        if cut_off >= np.min(cell_widths(cell)) / 2.0:
+            raise ValueError(
+                    'The cut-off %s is not less than half of the cell width'
+                    % cut_off
+                    )
+        return _cell_pairs(coords, cut_off, np.asarray(cell))
+    elif cut_off:
+        return _tree_pairs(coords, cut_off)
+    else:
+        return _block_pairs(coords)
+
+
+def cell_widths(cell):
+
+    """Gets the widths of a cell perpendicular to its three pairs of faces"""
+
+    cell = np.asarray(cell, dtype=np.float64)
+    volume = abs(np.linalg.det(cell))
+    return np.array([
+        volume / np.linalg.norm(np.cross(cell[(i + 1) % 3], cell[(i + 2) % 3]))
+        for i in xrange(0, 3)
+        ])
+
+
+def _block_pairs(coords):
+
+    """Finds all the intermolecular atomic pairs by blocks"""
+
+    mol_offsets = _offsets([ len(i) for i in coords ])
+    first = []
+    second = []
+    dists = []
+
+    for mol1, mol2 in itertools.combinations(xrange(0, len(coords)), 2):
+        block = cdist(coords[mol1], coords[mol2])
+        atm1, atm2 = np.indices(block.shape)
+        first.append(atm1.ravel() + mol_offsets[mol1])
+        second.append(atm2.ravel() + mol_offsets[mol2])
+        dists.append(block.ravel())
+        continue
+
+    if len(dists) == 0:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.float64))
+    return np.concatenate(first), np.concatenate(second), np.concatenate(dists)
+
+
+def _tree_pairs(coords, cut_off):
+
+    """Finds the intermolecular atomic pairs within the cut-off by KD-tree"""
+
+    all_coords = np.concatenate(
+            [np.empty((0, 3), dtype=np.float64)] + list(coords)
+            )
+    mol_idx = np.repeat(
+            np.arange(len(coords)), [ len(i) for i in coords ]
+            )
+    if len(all_coords) < 2:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.float64))
+
+    # The radius is slightly enlarged so that the pairs right on the cut-off
+    # are decided by the same distances as the other path.
+    tree = cKDTree(all_coords)
+    pairs = tree.query_pairs(
+            cut_off * (1.0 + 1.0E-10), output_type='ndarray'
+            )
+    first = pairs[:, 0].astype(np.int64)
+    second = pairs[:, 1].astype(np.int64)
+    dists = np.sqrt(
+            np.sum((all_coords[first] - all_coords[second]) ** 2, axis=1)
+            )
+    kept = (mol_idx[first] != mol_idx[second]) & (dists <= cut_off)
+    first, second, dists = first[kept], second[kept], dists[kept]
+
+    # Sort the pairs into the order of the block generation
+    order = np.lexsort((second, first, mol_idx[second], mol_idx[first]))
+
+    return first[order], second[order], dists[order]
+
+
+def _cell_pairs(coords, cut_off, cell):
+
+    """Finds the minimum-image intermolecular pairs by linked cells
+
+    The atoms are wrapped into the cell and binned by their fractional
+    coordinates into bins no narrower than the cut-off, so that only the atoms
+    in the 27 neighbouring bins need to be checked for each atom. With the
+    cut-off less than half of the cell width, the image within the cut-off is
+    always the one of the rounded fractional separation.
+
+    """
+
+    all_coords = np.concatenate(
+            [np.empty((0, 3), dtype=np.float64)] + list(coords)
+            )
+    mol_idx = np.repeat(
+            np.arange(len(coords)), [ len(i) for i in coords ]
+            )
+    n_atoms = len(all_coords)
+    if n_atoms < 2:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.float64))
+
+    frac = np.linalg.solve(cell.T, all_coords.T).T
+    frac -= np.floor(frac)
+
+    # The number of bins along each lattice vector, with the total number of
+    # bins limited by the number of atoms for sparse systems.
+    n_bins = np.maximum(
+            np.floor(cell_widths(cell) / cut_off).astype(np.int64), 1
+            )
+    if np.prod(n_bins) > n_atoms:
+        scale = (float(np.prod(n_bins)) / n_atoms) ** (1.0 / 3)
+        n_bins = np.maximum((n_bins / scale).astype(np.int64), 1)
+    bins = np.minimum((frac * n_bins).astype(np.int64), n_bins - 1)
+
+    def bin_id(bin_vecs):
+        return (bin_vecs[:, 0] * n_bins[1] + bin_vecs[:, 1]) * n_bins[2] + (
+                bin_vecs[:, 2]
+                )
+
+    atom_bins = bin_id(bins)
+    order = np.argsort(atom_bins, kind='mergesort')
+    counts = np.bincount(atom_bins, minlength=int(np.prod(n_bins)))
+    starts = _offsets(counts)[:-1]
+
+    # The distinct shifts of the bins along each lattice vector, for fewer
+    # than three bins the neighbours would be duplicated otherwise.
+    shifts = [ np.unique(np.array([-1, 0, 1]) % i) for i in n_bins ]
+
+    first = [ np.empty(0, dtype=np.int64) ]
+    second = [ np.empty(0, dtype=np.int64) ]
+    for shift in itertools.product(*shifts):
+        neigh_bins = bin_id((bins + np.array(shift)) % n_bins)
+        n_neighs = counts[neigh_bins]
+        atm1 = np.repeat(np.arange(n_atoms), n_neighs)
+        local = np.arange(len(atm1)) - np.repeat(
+                _offsets(n_neighs)[:-1], n_neighs
+                )
+        atm2 = order[starts[neigh_bins][atm1] + local]
+        kept = (atm1 < atm2) & (mol_idx[atm1] != mol_idx[atm2])
+        first.append(atm1[kept])
+        second.append(atm2[kept])
+        continue
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+
+    # The minimum-image distances
+    delta = frac[second] - frac[first]
+    delta -= np.round(delta)
+    dists = np.sqrt(np.sum(delta.dot(cell) ** 2, axis=1))
+    kept = dists <= cut_off
+    first, second, dists = first[kept], second[kept], dists[kept]
+
+    # Sort the pairs into the order of the block generation
+    order = np.lexsort((second, first, mol_idx[second], mol_idx[first]))
+
+    return first[order], second[order], dists[order]
@@ -0,0 +1,143 @@
+"""Defines the k-fold cross-validation of the fits
+
+The training residue alone cannot tell if a choice of the cut-off or the pair
+types generalizes to new configurations. Here the configurations are
+partitioned into folds, and for each fold the parameters are fitted to the
+rest of the configurations and then evaluated on the held-out fold.
+
+The fits of the folds are run concurrently in a pool of worker processes. Just
+like for the multi-start fits, the residue and Jacobian closures over the
+whole set are shared with the workers by the forking of the process, and each
+fold simply selects its training configurations out of them, so that the
+interactions are computed only once for all the folds.
+
+"""
+
+import numpy as np
+
+from .solvers import fit_trust_region
+from .workers import shared_pool
+
+
+def assign_folds(n_confs, n_folds, seed=None):
+
+    """Assigns the configurations to the folds randomly
+
+    :param int n_confs: The number of configurations.
+    :param int n_folds: The number of folds.
+    :param seed: The seed for the random number generator.
+    :return: The array of the fold index of each configuration, with the sizes
+      of the folds differing by at most one.
+
+    """
+
+    rand = np.random.RandomState(seed)
+    folds = np.empty(n_confs, dtype=np.intp)
+    folds[rand.permutation(n_confs)] = np.arange(n_confs) % n_folds
+    return folds
+
+
+def rms(values):
+
+    """Computes the root mean square of an array, zero for empty arrays"""
+
+    return float(np.sqrt(np.mean(values ** 2))) if len(values) > 0 else 0.0
+
+
+# The residue and Jacobian closures and the fitting options for the workers,
+# set before the pool is forked.
+_shared = {}
+
+
+def _fit_fold(fold):
+
+    """Fits the parameters to all the configurations out of a fold"""
+
+    residue = _shared['residue']
+    jacobi = _shared['jacobi']
+    train = _shared['folds'] != fold
+
+    def fold_residue(mp):
+        return residue(mp)[train]
+
+    if jacobi is not None:
+        def fold_jacobi(mp):
+            return jacobi(mp)[:, train]
+    else:
+        fold_jacobi = None
+
+    fit_result = fit_trust_region(
+            fold_residue, fold_jacobi, _shared['ig'], _shared['bounds'],
+            method=_shared['method'], tol=_shared['tol'],
+            max_nfev=_shared['max_nfev']
+            )
+    res = residue(fit_result.x)
+
+    return (
+            fold, fit_result.x, rms(res[train]), rms(res[~train]),
+            fit_result.status > 0, fit_result.nfev
+            )
+
+
+def run_cross_validation(residue, jacobi, folds, ig, bounds, method='TRF',
+                         tol=1.0E-8, max_nfev=None, jobs=1):
+
+    """Runs the fits for all the folds
+
+    :param residue: The residue closure over all the configurations.
+    :param jacobi: The Jacobian closure over all the configurations, or None
+      for finite differences.
+    :param folds: The array of the fold index of each configuration, as given
+      by :py:func:`assign_folds`.
+    :param ig: The initial guess of the parameters.
+    :param bounds: The list of pairs of bounds for the parameters.
+    :param method: The trust-region method, as in
+      :py:func:`morsefit.solvers.fit_trust_region`.
+    :param float tol: The tolerance for the fits.
+    :param max_nfev: The maximum number of residue evaluations of each fit.
+    :param int jobs: The number of worker processes.
+    :return: The list of the results of the folds, given as tuples of the
+      index of the fold, the fitted parameters, the training RMSE, the
+      held-out RMSE, whether it has converged, and the number of residue
+      evaluations. The list is sorted by the index of the fold.
+
+    """
+
+    n_folds = int(np.max(folds)) + 1
+
+    with shared_pool(_shared, {
+            'residue': residue,
+            'jacobi': jacobi,
+            'folds': folds,
+            'ig': ig,
+            'bounds': bounds,
+            'method': method,
+            'tol': tol,
+            'max_nfev': max_nfev
+            }, min(jobs, n_folds)) as mapper:
+        results = mapper(_fit_fold, range(0, n_folds))
+
+    return sorted(results, key=lambda x: x[0])
+
+
+def held_out_rmse(residue, folds, fits):
+
+    """Computes the aggregate held-out RMSE over all the folds
+
+    Each configuration is evaluated with the parameters fitted without its
+    fold, and the RMSE is taken over all the configurations.
+
+    :param residue: The residue closure over all the configurations.
+    :param folds: The array of the fold index of each configuration.
+    :param fits: The results of the folds, as given by
+      :py:func:`run_cross_validation`.
+
+    """
+
+    held_out = np.empty(len(folds), dtype=np.float64)
+    for i_fit in fits:
+        mask = folds == i_fit[0]
+        held_out[mask] = residue(i_fit[1])[mask]
+        continue
+
+    return rms(held_out)
@@ -1,5 +1,6 @@
 """Defines the driver function for the fitter"""
 
+import os
 import sys
 import argparse
 
@@ -7,9 +8,30 @@ import numpy as np
 from numpy import linalg
 from scipy import optimize
 
-from .inputread import read_morse_inp, read_configuration
+from .inputread import read_morse_inp, read_configuration_set, read_dataset
+from .configuration import ConfigurationSet
+from .cache import gen_cache_key, read_cached_set
+from .session import Session, load_session, save_session
+from .checkpoint import dataset_fingerprint, save_checkpoint, load_checkpoint
 from .residue import gen_rj_func
-from .leastsq2opt import conv_residue, conv_jacobi
+from .memo import MemoizedClosure, memoize_rj
+from .blocked import BlockedEvaluator
+from .jit import HAS_NUMBA, check_closures
+from .profiling import PROFILER, Telemetry
+from .leastsq2opt import conv_residue, conv_fun_grad
+from .solvers import (
+        TRUST_REGION_METHODS, NORMAL_EQUATIONS_METHOD, fit_trust_region,
+        fit_normal_equations
+        )
+from .multistart import sample_starts, run_multistart
+from .crossval import assign_folds, run_cross_validation, held_out_rmse
+
+
+# The number of the best fits to be printed in the multi-start mode
+N_RANKED_FITS = 5
+
+# The default number of configurations in each block for the normal equations
+NORMAL_EQUATIONS_BLOCK_SIZE = 1000
 
 
 def write_param(morse_guess, res_param):
@@ -35,6 +57,70 @@ def write_param(morse_guess, res_param):
     print "\n"
 
 
+def read_session(dir_name, file_names, cut_off, morse_guess, reader):
+
+    """Reads the configurations through a fit session
+
+    Only the files that are not in the session are read and appended to it.
+    When any of the files in the session have been modified, or the session
+    does not exist yet, a new session is started from the given files, with
+    the parameters of the last fit still kept for the warm start.
+
+    :param dir_name: The directory of the session.
+    :param file_names: The list of names of the configuration files.
+    :param cut_off: The cut-off for the interactions.
+    :param morse_guess: The list of initial guesses for the Morse potential.
+    :param reader: The function to read the configuration set from the files
+      and the cut-off.
+    :return: The session, with all the configurations.
+
+    """
+
+    # The files are going to be keyed by their status in the session.
+    try:
+        gen_cache_key(file_names, None)
+    except OSError as exc:
+        print " File %s cannot be opened! " % exc.filename
+        sys.exit(1)
+
+    session = load_session(dir_name)
+    last_fit = (None, None)
+
+    if session is not None and session.cut_off != cut_off:
+        print "The session %s has cut-off %s rather than %s!" % (
+                dir_name, session.cut_off, cut_off
+                )
+        sys.exit(1)
+
+    if session is not None:
+        new_files, changed_files = session.split_files(file_names)
+        if len(changed_files) > 0:
+            print "%d files have been modified since the session, " % (
+                    len(changed_files)
+                    ) + "starting a new session..."
+            last_fit = (session.pairs, session.params)
+            session = None
+
+    if session is None:
+        session = Session(
+                reader(file_names, cut_off),
+                gen_cache_key(file_names, None)['files'], cut_off,
+                [ list(i[0]) for i in morse_guess ]
+                )
+        if last_fit[1] is not None:
+            session.pairs, session.params = last_fit
+        print "New session started in %s..." % dir_name
+    elif len(new_files) > 0:
+        session.append(new_files, reader(new_files, cut_off))
+        print "%d new files appended to the session %s..." % (
+                len(new_files), dir_name
+                )
+    else:
+        print "No new files for the session %s..." % dir_name
+
+    return session
+
+
 def main():
 
     """The main driver function for the fitter
@@ -71,40 +157,210 @@ def main():
     parser.add_argument('-d', '--diagonal', default=None, action='store',
                         help='The diagonal scaling coefficient, can be a '
                              'single positive number or a list')
-    parser.add_argument('confs', nargs='+',
-                        help='The configuration files')
+    parser.add_argument('-C', '--cache', default=None, action='store',
+                        help='The directory for caching the parsed '
+                             'configurations, default to no caching')
+    parser.add_argument('--jobs', default=1, action='store', type=int,
+                        help='The number of processes for reading the '
+                             'configurations and the multi-start fits')
+    parser.add_argument('--dedup', default=None, action='store', type=float,
+                        help='Merge the duplicated distances within the given '
+                             'tolerance, zero for identical distances only')
+    parser.add_argument('--multistart', default=None, action='store',
+                        type=int, help='Fit from the given number of starts '
+                        'sampled within the bounds')
+    parser.add_argument('--seed', default=None, action='store', type=int,
+                        help='The random seed for sampling the starts')
+    parser.add_argument('--backend', default='numpy', action='store',
+                        choices=['numpy', 'numba'],
+                        help='The backend for evaluating the residue and '
+                             'Jacobian, default to numpy')
+    parser.add_argument('--threads', default=1, action='store', type=int,
+                        help='The number of threads for evaluating the '
+                             'residue and Jacobian')
+    parser.add_argument('-b', '--block-size', default=None, action='store',
+                        type=int, help='Evaluate in blocks of the given number '
+                        'of configurations, without the dense Jacobian')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Print the wall time and the number of calls of '
+                             'the phases of the fitting')
+    parser.add_argument('--telemetry', default=None, action='store',
+                        help='The file for the JSON-lines records of the '
+                             'iterations')
+    parser.add_argument('--session', default=None, action='store',
+                        help='The directory of the session for incremental '
+                             'fitting')
+    parser.add_argument('--checkpoint', default=None, action='store',
+                        help='The file for the checkpoints of the fit')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help='Resume the fit from the checkpoint')
+    parser.add_argument('--cv', default=None, action='store', type=int,
+                        help='Cross-validate with the given number of folds '
+                             'before the fit to all the configurations')
+    parser.add_argument('--dataset', default=None, action='store',
+                        help='The directory of a binary data set of '
+                             'configurations, as written by readPES')
+    parser.add_argument('confs', nargs='*',
+                        help='The configuration files or bundles')
     args = parser.parse_args()
 
+    if len(args.confs) == 0 and args.dataset is None:
+        print "No configurations are given!"
+        sys.exit(1)
+    if args.dataset is not None and args.session is not None:
+        print "Binary data sets cannot be used in sessions!"
+        sys.exit(1)
+
     try:
         cut_off = float(args.cutoff) if args.cutoff != None else None
     except ValueError:
         print "Invalid cut-off %s given!" % args.cutoff
         sys.exit(1)
 
+    if args.telemetry is not None and args.multistart is not None:
+        print "Telemetry is not supported in the multi-start mode!"
+        sys.exit(1)
+
     try:
         morse_file = open(args.guess)
     except IOError:
         print "The file %s cannot be opened for the initial guess!" % args.guess
         sys.exit(1)
 
+    # Load the checkpoint
+    # -------------------
+
+    checkpoint = None
+    fingerprint = None
+    if args.checkpoint is not None:
+        if args.multistart is not None:
+            print "Checkpoints are not supported in the multi-start mode!"
+            sys.exit(1)
+        fingerprint_files = list(args.confs)
+        if args.dataset is not None:
+            fingerprint_files.append(os.path.join(args.dataset, 'meta.json'))
+        try:
+            fingerprint = dataset_fingerprint(fingerprint_files, cut_off)
+        except OSError as exc:
+            print "The configuration file %s cannot be found!" % exc.filename
+            sys.exit(1)
+
+    if args.resume:
+        if args.checkpoint is None:
+            print "The checkpoint file has to be given for resuming!"
+            sys.exit(1)
+        checkpoint = load_checkpoint(args.checkpoint)
+        if checkpoint is None:
+            print "The checkpoint %s cannot be read!" % args.checkpoint
+            sys.exit(1)
+        if checkpoint['fingerprint'] != fingerprint:
+            print "The checkpoint %s is for a different data set!" % (
+                    args.checkpoint
+                    )
+            sys.exit(1)
+        if checkpoint['method'] != args.method:
+            print "The checkpoint %s is for method %s rather than %s!" % (
+                    args.checkpoint, checkpoint['method'], args.method
+                    )
+            sys.exit(1)
+        # Reuse the cache of the checkpointed run to avoid the parsing.
+        if args.cache is None:
+            args.cache = checkpoint['cache']
+
     # Parse the input files
     # ---------------------
 
     morse_guess = read_morse_inp(morse_file)
-    confs = [ read_configuration(i, cut_off) for i in args.confs ]
+    reader = lambda file_names, cut_off: read_configuration_set(
+            file_names, cut_off, jobs=args.jobs
+            )
+    with PROFILER.phase('read'):
+        if args.session is not None:
+            session = read_session(
+                    args.session, args.confs, cut_off, morse_guess, reader
+                    )
+            confs, cache_hit = session.conf_set, False
+        else:
+            session = None
+            conf_sets = []
+            cache_hit = False
+            if args.dataset is not None:
+                conf_sets.append(read_dataset(args.dataset, cut_off))
+            if len(args.confs) > 0:
+                file_set, cache_hit = read_cached_set(
+                        args.confs, cut_off, args.cache, reader
+                        )
+                conf_sets.append(file_set)
+            if len(conf_sets) > 1:
+                confs = ConfigurationSet.concatenate(conf_sets)
+            else:
+                confs = conf_sets[0]
+    if cache_hit:
+        print "Configurations loaded from the cache %s..." % args.cache
 
     print "Configurations and the initial guess has been read..."
 
     # Generate the closures
     # ---------------------
 
-    residue, jacobi = gen_rj_func(confs, morse_guess)
+    normal_eqs = args.method == NORMAL_EQUATIONS_METHOD
+
+    if args.block_size is not None or normal_eqs:
+
+        # Without the dense Jacobian, only the general minimizers and the
+        # solver on the normal equations can be used.
+        if (args.method == 'LMA' or args.method in TRUST_REGION_METHODS
+                or args.multistart is not None or args.cv is not None):
+            print "Blocked evaluation is not supported by method %s, " % (
+                    args.method
+                    ) + "or for multiple starts and cross-validation!"
+            sys.exit(1)
+        if normal_eqs and args.no_jacobian:
+            print "Method %s needs the analytic Jacobian!" % args.method
+            sys.exit(1)
+        evaluator = BlockedEvaluator(
+                confs, morse_guess,
+                args.block_size if args.block_size is not None
+                else NORMAL_EQUATIONS_BLOCK_SIZE
+                )
+        residue = MemoizedClosure(PROFILER.wrap('residue', evaluator.residue))
+        jacobi = None
+
+    else:
+
+        residue, jacobi = gen_rj_func(
+                confs, morse_guess, dedup_tol=args.dedup, backend=args.backend,
+                threads=args.threads
+                )
+        if args.backend == 'numba' and HAS_NUMBA and args.dedup is None:
+            ref_residue, ref_jacobi = gen_rj_func(confs, morse_guess)
+            mp = np.array([ j for i in morse_guess for j in i[1] ])
+            if not check_closures(
+                    residue, jacobi, ref_residue, ref_jacobi, mp
+                    ):
+                print "Backend %s disagrees with numpy, numpy is used..." % (
+                        args.backend
+                        )
+                residue, jacobi = ref_residue, ref_jacobi
+            # The reference closures hold their own copies of the
+            # interactions, which should not be kept alive for the whole fit.
+            del ref_residue, ref_jacobi
+        residue, jacobi = memoize_rj(
+                PROFILER.wrap('residue', residue),
+                PROFILER.wrap('jacobi', jacobi)
+                )
+
     print "Closures for the residue and Jacobian generated..."
     N = len(morse_guess) * 3
     M = len(confs)
-    if args.method != 'LMA':
-	residue_gen = conv_residue(residue, N, M)
-	jacobi_gen = conv_jacobi(jacobi, residue, N, M)
+    if (args.method != 'LMA' and args.method not in TRUST_REGION_METHODS
+            and not normal_eqs):
+        if args.no_jacobian:
+            objective = conv_residue(residue, N, M)
+        elif args.block_size is not None:
+            objective = PROFILER.wrap('fun_grad', evaluator.fun_grad)
+        else:
+            objective = conv_fun_grad(residue, jacobi, N, M)
 
     # Perform the fit
     # ---------------
@@ -121,6 +377,64 @@ def main():
             continue
         continue
 
+    # Warm start from the last fit of the session
+    if session is not None:
+        warm_ig = session.warm_start(morse_guess)
+        if warm_ig is not None:
+            ig = warm_ig
+            print "Warm start from the last fit of the session..."
+
+    # Resume from the checkpoint
+    first_step = 0
+    prior_step = 0
+    prior_nfev = 0
+    if checkpoint is not None:
+        if checkpoint['pairs'] != [ list(i[0]) for i in morse_guess ]:
+            print "The checkpoint %s is for different Morse potentials!" % (
+                    args.checkpoint
+                    )
+            sys.exit(1)
+        ig = checkpoint['param']
+        first_step = min(checkpoint['step'], max(args.steps - 1, 0))
+        prior_step = checkpoint['step']
+        prior_nfev = checkpoint['nfev']
+        print "Resumed from the checkpoint %s at step %d..." % (
+                args.checkpoint, checkpoint['step']
+                )
+
+    def write_checkpoint(param, step, nfev):
+        if args.checkpoint is not None:
+            save_checkpoint(
+                    args.checkpoint, param, step=step, nfev=nfev,
+                    method=args.method, fingerprint=fingerprint,
+                    pairs=[ list(i[0]) for i in morse_guess ],
+                    cache=(os.path.abspath(args.cache)
+                           if args.cache is not None else None)
+                    )
+        return None
+
+    # The records of the iterations, which are made when the Jacobian is
+    # evaluated for solvers without the support of callbacks, or once per
+    # trunk when there is not even the Jacobian to hook into.
+    telemetry = Telemetry(args.telemetry) if args.telemetry else None
+
+    def record_iteration(param):
+        if telemetry is not None:
+            telemetry.record(
+                    param, linalg.norm(residue(param)), method=args.method
+                    )
+        return None
+
+    # leastsq evaluates the Jacobian once at the initial guess to check its
+    # shape before iterating, which is not an iteration to be recorded.
+    dfun_checked = [False]
+
+    def jacobi_w_record(param):
+        if dfun_checked[0]:
+            record_iteration(param)
+        dfun_checked[0] = True
+        return jacobi(param)
+
     # set the options to the solveer
     trunk_size = args.trunk_size
 
@@ -133,7 +447,7 @@ def main():
 		'ftol': args.tolerance
 		}
 	if not args.no_jacobian:
-	    opts['Dfun'] = jacobi
+	    opts['Dfun'] = jacobi_w_record
 	    opts['col_deriv'] = True
 	if args.diagonal != None:
 	    diag_input = eval(args.diagonal)
@@ -145,7 +459,7 @@ def main():
 		diag = diag_input
 	    opts['diag'] = diag
 
-    else:
+    elif args.method not in TRUST_REGION_METHODS and not normal_eqs:
 
 	opts = {
 		'method': args.method,
@@ -158,43 +472,195 @@ def main():
 	if bounds != (None, ) * N:
 	    opts['bounds'] = bounds
 	if not args.no_jacobian:
-	    opts['jac'] = jacobi_gen
+	    opts['jac'] = True
+	opts['callback'] = record_iteration
 	
 
-    # The main loop
-    print "Entering optimization main loop...\n"
-    for step in xrange(0, args.steps):
+    # The residue evaluations of the solvers running in one call, counted from
+    # the checkpoint when resumed, so that the resumed run keeps to the same
+    # total budget.
+    solver_nfev = [prior_nfev]
+    solver_budget = max(trunk_size * args.steps - prior_nfev, 1)
+
+    def counted_residue(param):
+        solver_nfev[0] += 1
+        return residue(param)
+
+    # Cross-validation
+    if args.cv is not None:
+
+        if args.cv < 2 or args.cv > len(confs):
+            print "Invalid number of folds %d for %d configurations!" % (
+                    args.cv, len(confs)
+                    )
+            sys.exit(1)
+
+        folds = assign_folds(len(confs), args.cv, seed=args.seed)
+        print "Entering %d-fold cross-validation...\n" % args.cv
+        cv_fits = run_cross_validation(
+                residue, None if args.no_jacobian else jacobi, folds, ig,
+                bounds, method=(args.method if args.method in
+                                TRUST_REGION_METHODS else 'TRF'),
+                tol=args.tolerance, max_nfev=trunk_size * args.steps,
+                jobs=args.jobs
+                )
+
+        print " %5s %10s %10s %20s %20s %10s %10s " % (
+                "Fold", "Training", "Held-out", "Training RMSE",
+                "Held-out RMSE", "Converged", "Calls"
+                )
+        for i_fit in cv_fits:
+            n_test = np.count_nonzero(folds == i_fit[0])
+            print " %5d %10d %10d %20.10f %20.10f %10s %10d " % (
+                    i_fit[0], len(confs) - n_test, n_test, i_fit[2],
+                    i_fit[3], i_fit[4], i_fit[5]
+                    )
+            continue
+        print ""
+        print " Held-out RMSE over all the folds: %f" % held_out_rmse(
+                residue, folds, cv_fits
+                )
+        print " Mean held-out RMSE of the folds: %f" % np.mean(
+                [ i[3] for i in cv_fits ]
+                )
+        print "\nCross-validation finished, fitting all the configurations...\n"
+
+    if args.multistart is not None:
+
+        starts = sample_starts(ig, bounds, args.multistart, seed=args.seed)
+        print "Entering multi-start optimization with %d starts...\n" % (
+                len(starts)
+                )
+        fits = run_multistart(
+                residue, None if args.no_jacobian else jacobi, starts, bounds,
+                method=(args.method if args.method in TRUST_REGION_METHODS
+                        else 'TRF'),
+                tol=args.tolerance, round_nfev=trunk_size,
+                max_rounds=args.steps, jobs=args.jobs
+                )
+
+        print " %5s %25s %10s %10s %10s " % (
+                "Start", "Residue", "Converged", "Rounds", "Calls"
+                )
+        for i_fit in fits:
+            print " %5d %25.10f %10s %10d %10d " % (
+                    i_fit[0], i_fit[2], i_fit[3], i_fit[5], i_fit[4]
+                    )
+            continue
+        for i_fit in fits[:N_RANKED_FITS]:
+            print ""
+            print " Start %d: Residue = %f" % (i_fit[0], i_fit[2])
+            write_param(morse_guess, i_fit[1])
+            continue
 
-	if args.method == 'LMA':
-	    fit_result = optimize.leastsq(residue, ig, **opts)
-	    ig = fit_result[0]
-	    succ = fit_result[4] in [1, 2, 3, 4]
-	else:
-	    fit_result = optimize.minimize(residue_gen, ig, **opts)
-	    ig = fit_result.x
-	    succ = fit_result.success
+        best = fits[0]
+        ig = best[1]
+        succ = best[3]
+        fit_result = optimize.OptimizeResult(
+                x=ig, success=succ, nfev=sum(i[4] for i in fits),
+                message='The best start has not converged.'
+                )
+
+    elif args.method in TRUST_REGION_METHODS or normal_eqs:
+
+        # The whole optimization in one call, with progress reported for each
+        # iteration.
+        def report_progress(n_iter, param):
+            print " Iteration %d: Residue = %f" % (
+                    n_iter, linalg.norm(residue(param))
+                    )
+            record_iteration(param)
+            write_checkpoint(param, prior_step + n_iter, solver_nfev[0])
+            return None
+
+        if normal_eqs:
+            print "Entering optimization on the normal equations...\n"
+            fit_result = fit_normal_equations(
+                    PROFILER.wrap(
+                        'normal_equations', evaluator.normal_equations
+                        ),
+                    counted_residue, ig, bounds, tol=args.tolerance,
+                    max_iter=solver_budget, callback=report_progress
+                    )
+        else:
+            print "Entering trust-region optimization...\n"
+            fit_result = fit_trust_region(
+                    counted_residue, None if args.no_jacobian else jacobi, ig,
+                    bounds, method=args.method, tol=args.tolerance,
+                    max_nfev=solver_budget, callback=report_progress
+                    )
+        ig = fit_result.x
+        succ = fit_result.success
 
         print ""
-        print " Step %s: Residue = %f" % (
-                (step + 1) * trunk_size,
-                linalg.norm(residue(ig))
-		)
+        print " Final: Residue = %f" % linalg.norm(residue(ig))
         write_param(morse_guess, ig)
         print "\n"
-        if succ:
-            break
-        continue
+
+    else:
+
+        # The main loop
+        print "Entering optimization main loop...\n"
+        total_nfev = prior_nfev
+        for step in xrange(first_step, args.steps):
+
+            if args.method == 'LMA':
+                dfun_checked[0] = False
+                fit_result = optimize.leastsq(residue, ig, **opts)
+                ig = fit_result[0]
+                succ = fit_result[4] in [1, 2, 3, 4]
+                total_nfev += fit_result[2]['nfev']
+                if args.no_jacobian:
+                    record_iteration(ig)
+            else:
+                fit_result = optimize.minimize(objective, ig, **opts)
+                ig = fit_result.x
+                succ = fit_result.success
+                total_nfev += fit_result.nfev
+
+            print ""
+            print " Step %s: Residue = %f" % (
+                    (step + 1) * trunk_size,
+                    linalg.norm(residue(ig))
+                    )
+            write_param(morse_guess, ig)
+            print "\n"
+            write_checkpoint(ig, step + 1, total_nfev)
+            if succ:
+                break
+            continue
+
     print "\nOptimization finished..."
 
     # Post processing
     # ---------------
 
-    mesg = fit_result[3] if args.method == 'LMA' else fit_result.message
-    nfev = info_dict['nfev'] if args.method == 'LMA' else fit_result.nfev
+    trunked = (args.multistart is None and not normal_eqs
+               and args.method not in TRUST_REGION_METHODS)
+    lma = args.method == 'LMA' and args.multistart is None
+    mesg = fit_result[3] if lma else fit_result.message
+    if trunked:
+        nfev = total_nfev
+    elif args.multistart is None:
+        nfev = solver_nfev[0]
+    else:
+        nfev = fit_result.nfev
     res_param = ig
 
     # Convergence information
     print " Number of function calls: %d" % nfev
+    if ((args.method in TRUST_REGION_METHODS or normal_eqs)
+            and args.multistart is None and not args.no_jacobian):
+        print " Number of Jacobian calls: %d" % fit_result.njev
+    # The closures are only evaluated in the workers for multiple starts.
+    if args.multistart is None:
+        print " Residue evaluations cached/computed: %d/%d" % (
+                residue.hits, residue.misses
+                )
+        if jacobi is not None:
+            print " Jacobian evaluations cached/computed: %d/%d" % (
+                    jacobi.hits, jacobi.misses
+                    )
     if succ:
         print "Convergence achieved!"
     else:
@@ -202,10 +668,10 @@ def main():
         print " Reason: %s" % mesg
 
     # Output the comparison of the fitted and Ab-initio energies.
-    ab_initio_e = [ i.ab_initio_e for i in confs ]
-    file_names = [ i.file_name for i in confs ]
-    tags = [ i.tag for i in confs ]
-    morse_e = np.array(ab_initio_e) + residue(res_param) 
+    ab_initio_e = confs.ab_initio_e
+    file_names = confs.file_names
+    tags = confs.tags
+    morse_e = ab_initio_e + residue(res_param)
     print " %20s %20s %25s %25s " %(
             "File Name", "tag", "Ab-initio", "Morse"
             )
@@ -224,5 +690,26 @@ def main():
     # write the resulted parameters
     write_param(morse_guess, res_param)
 
+    # Update the session with the new fit
+    if session is not None:
+        session.params = res_param
+        session.pairs = [ list(i[0]) for i in morse_guess ]
+        session.state = {
+                'method': args.method,
+                'nfev': int(nfev),
+                'residue': float(linalg.norm(morse_e - ab_initio_e)),
+                'converged': bool(succ),
+                'n_confs': len(confs)
+                }
+        save_session(args.session, session)
+        print "Session saved in %s..." % args.session
+
+    if telemetry is not None:
+        telemetry.close()
+    if args.profile:
+        print "Profile of the phases of the fitting:"
+        PROFILER.report()
+        print ""
+
     return 0
 
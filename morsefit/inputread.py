@@ -1,10 +1,20 @@
 """Defines the subroutines for reading the input files"""
 
 import sys
+import itertools
+import multiprocessing
 
 import numpy as np
 
-from .configuration import Configuration
+from .configuration import Configuration, ConfigurationSet
+from .profiling import PROFILER
+
+
+# The separator for the records in the bundles of configurations
+BUNDLE_SEPARATOR = '%%'
+
+# The keyword for the line of the lattice cell of periodic configurations
+CELL_KEYWORD = 'cell'
 
 
 def read_morse_inp(inp_file):
@@ -77,6 +87,23 @@ def read_configuration(file_name, cut_off):
 
     """
 
+    conf = parse_configuration(file_name)
+    # Resolve the interactions based on the given cut-off.
+    conf.calc_interactions(cut_off)
+
+    return conf
+
+
+def parse_configuration(file_name):
+
+    """Parse the configuration from a file without resolving interactions
+
+    :param file_name: The file name for the configuration file.
+    :return: The :py:class:`Configuration` object with just the molecules
+      added.
+
+    """
+
     # Open the input file
     try:
         f = open(file_name)
@@ -84,10 +111,24 @@ def read_configuration(file_name, cut_off):
         print " File %s cannot be opened! " % file_name
         sys.exit(1)
 
+    with f:
+        return _parse_lines(f, file_name)
+
+
+def _parse_lines(lines, file_name):
+
+    """Parse a configuration from the lines of its input
+
+    :param lines: An iterable of the input lines.
+    :param file_name: The name of the configuration, for error reporting and
+      the file name of the configuration.
+
+    """
+
     # Break the input lines into sections
     sections = []
     cur_section = []
-    for line in f:
+    for line in lines:
         stripped = line.strip()
         if len(stripped) != 0:
             cur_section.append(stripped)
@@ -107,11 +148,16 @@ def read_configuration(file_name, cut_off):
         print "Incorrect ab-initio energy in %s" % file_name
         sys.exit(1)
 
-    # Get the optional tag
-    try:
-        tag = sections[0][1]
-    except IndexError:
-        tag = ''
+    # Get the optional tag and the optional cell for periodic configurations
+    tag = ''
+    cell = None
+    for idx, line in enumerate(sections[0][1:]):
+        fields = line.split()
+        if fields[0] == CELL_KEYWORD:
+            cell = _parse_cell(fields[1:], file_name)
+        elif idx == 0:
+            tag = line
+        continue
 
     # Parse the atomic coordinates in the molecules
     molecules = []
@@ -133,14 +179,291 @@ def read_configuration(file_name, cut_off):
 
     # Initialize the basic info in the Configuration object.
     conf = Configuration(file_name, tag, ab_initio_e)
+    conf.cell = cell
     # Add the molecules.
     for i in molecules:
         conf.add_molecule(i)
         continue
-    # Resolve the interactions based on the given cut-off.
-    conf.calc_interactions(cut_off)
 
     return conf
 
 
-
+def _parse_cell(fields, file_name):
+
+    """Parse the lattice cell of a periodic configuration
+
+    The cell can be given as three numbers for the lengths of the edges of a
+    rectangular box, or as nine numbers for the three lattice vectors.
+
+    :param fields: The fields following the cell keyword.
+    :param file_name: The name of the configuration, for error reporting.
+    :return: The :math:`3\\times{}3` array with the lattice vectors as rows.
+
+    """
+
+    try:
+        values = [ float(i) for i in fields ]
+    except ValueError:
+        values = []
+
+    if len(values) == 3:
+        cell = np.diag(values)
+    elif len(values) == 9:
+        cell = np.array(values).reshape((3, 3))
+    else:
+        print "Incorrect cell in %s, three or nine numbers expected!" % (
+                file_name
+                )
+        sys.exit(1)
+
+    if abs(np.linalg.det(cell)) <= 0.0:
+        print "Degenerate cell in %s!" % file_name
+        sys.exit(1)
+
+    return cell
+
+
+def is_bundle(file_name):
+
+    """Tests if a file is a bundle of configurations
+
+    A bundle contains many configurations in the same format as the
+    configuration files, with each of them started by a line beginning with
+    the record separator ``%%``. An optional name can be given after the
+    separator on the same line. So a file is a bundle when its first non-blank
+    line begins with the separator.
+
+    """
+
+    try:
+        f = open(file_name)
+    except IOError:
+        print " File %s cannot be opened! " % file_name
+        sys.exit(1)
+
+    with f:
+        return _sniff_bundle(f)[0]
+
+
+def _sniff_bundle(f):
+
+    """Tests if an open file is a bundle by its first non-blank line
+
+    :param f: The file opened for reading.
+    :return: If the file is a bundle, and the iterable over all the lines of
+      the file, including the ones read for the test.
+
+    """
+
+    head = []
+    for line in f:
+        head.append(line)
+        if len(line.strip()) != 0:
+            break
+        continue
+
+    bundle = len(head) > 0 and head[-1].strip().startswith(BUNDLE_SEPARATOR)
+    return bundle, itertools.chain(head, f)
+
+
+def iter_bundle(file_name):
+
+    """Iterate over the configurations in a bundle
+
+    The bundle is read line by line, with the configurations parsed and
+    yielded one after another, so the whole file is never loaded. The
+    configurations are named by the bundle file name and the name given after
+    the separator, or the zero-based index of the record when the name is
+    absent, separated by a colon.
+
+    :param file_name: The name of the bundle file.
+    :return: A generator of :py:class:`Configuration` objects with just the
+      molecules added.
+
+    """
+
+    try:
+        f = open(file_name)
+    except IOError:
+        print " File %s cannot be opened! " % file_name
+        sys.exit(1)
+
+    with f:
+        for conf in _iter_bundle_lines(f, file_name):
+            yield conf
+            continue
+
+
+def _iter_bundle_lines(bundle_lines, file_name):
+
+    """Iterate over the configurations in the lines of a bundle
+
+    :param bundle_lines: An iterable of the lines of the bundle.
+    :param file_name: The name of the bundle file, for naming the
+      configurations.
+
+    """
+
+    name = None
+    lines = []
+    idx = 0
+    for line in bundle_lines:
+        stripped = line.strip()
+        if stripped.startswith(BUNDLE_SEPARATOR):
+            if name is not None:
+                yield _parse_lines(lines, name)
+            label = stripped[len(BUNDLE_SEPARATOR):].strip()
+            name = '%s:%s' % (file_name, label if label else idx)
+            lines = []
+            idx += 1
+        elif name is None:
+            if len(stripped) != 0:
+                print "In bundle %s, no record separator before: " % (
+                        file_name
+                        )
+                print stripped
+                sys.exit(1)
+        elif len(lines) != 0 or len(stripped) != 0:
+            # Leading blank lines of the records are skipped.
+            lines.append(line)
+        continue
+
+    if name is not None:
+        yield _parse_lines(lines, name)
+
+
+def iter_configurations(file_names):
+
+    """Iterate over the configurations in plain files and bundles
+
+    :param file_names: The list of names of the configuration files or the
+      bundles.
+    :return: A generator of :py:class:`Configuration` objects, in the order of
+      the files and the order of the records in the bundles.
+
+    """
+
+    # Each file is opened only once, with the lines read for telling the
+    # bundles apart handed on to the parsers.
+    for i in file_names:
+        try:
+            f = open(i)
+        except IOError:
+            print " File %s cannot be opened! " % i
+            sys.exit(1)
+
+        with f:
+            bundle, lines = _sniff_bundle(f)
+            if bundle:
+                for conf in _iter_bundle_lines(lines, i):
+                    yield conf
+                    continue
+            else:
+                yield _parse_lines(lines, i)
+        continue
+
+def read_configuration_set(file_names, cut_off, jobs=1):
+
+    """Read the configurations from files into a configuration set
+
+    The files are parsed one after another into the compact
+    :py:class:`ConfigurationSet`, and then the interactions are resolved
+    directly from its arrays. When more than one job is requested, the list of
+    files is split into consecutive chunks, which are read in a pool of worker
+    processes. The workers send back their configuration sets as arrays, which
+    are concatenated in the original order of the files.
+
+    :param file_names: The list of file names of the configuration files or
+      bundles of configurations.
+    :param cut_off: The cut-off for the pairwise interactions.
+    :param int jobs: The number of worker processes.
+
+    """
+
+    if jobs <= 1 or len(file_names) < 2:
+        return _read_chunk(file_names, cut_off)
+
+    # A few chunks for each worker for better load balancing.
+    n_chunks = min(len(file_names), jobs * 4)
+    bounds = [
+            len(file_names) * i // n_chunks for i in xrange(0, n_chunks + 1)
+            ]
+    chunks = [
+            (file_names[bounds[i]:bounds[i + 1]], cut_off)
+            for i in xrange(0, n_chunks)
+            ]
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(_read_chunk_worker, chunks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    conf_sets = []
+    for conf_set, snapshot in results:
+        PROFILER.merge(snapshot)
+        conf_sets.append(conf_set)
+        continue
+    if any(i is None for i in conf_sets):
+        sys.exit(1)
+
+    return ConfigurationSet.concatenate(conf_sets)
+
+
+def read_dataset(dir_name, cut_off):
+
+    """Read a binary data set of configurations
+
+    The data set is a configuration set saved by
+    :py:meth:`ConfigurationSet.save`, like the ones written by the ``readPES``
+    script, whose arrays are memory mapped rather than parsed. The
+    interactions are resolved from the coordinates for the given cut-off.
+
+    :param dir_name: The directory of the data set.
+    :param cut_off: The cut-off for the pairwise interactions.
+
+    """
+
+    try:
+        with PROFILER.phase('parse'):
+            conf_set = ConfigurationSet.load(dir_name, mmap=True)
+    except (IOError, ValueError):
+        print "The data set %s cannot be read!" % dir_name
+        sys.exit(1)
+
+    with PROFILER.phase('interactions'):
+        conf_set.calc_interactions(cut_off)
+
+    return conf_set
+
+
+def _read_chunk(file_names, cut_off):
+
+    """Read a list of configuration files into a configuration set"""
+
+    with PROFILER.phase('parse'):
+        conf_set = ConfigurationSet.from_configurations(
+                iter_configurations(file_names)
+                )
+    with PROFILER.phase('interactions'):
+        conf_set.calc_interactions(cut_off)
+
+    return conf_set
+
+
+def _read_chunk_worker(args):
+
+    """Read a chunk of configuration files in a worker process
+
+    The errors in the input files are reported by the parser before exiting,
+    here the exit is turned into a None result for the main process. The
+    records of the profiler of the worker are sent back as well.
+
+    """
+
+    PROFILER.clear()
+    try:
+        return _read_chunk(*args), PROFILER.snapshot()
+    except SystemExit:
+        return None, PROFILER.snapshot()
@@ -0,0 +1,126 @@
+"""Defines the optional JIT-compiled residue and Jacobian backend
+
+Even with the array kernels, the NumPy evaluation of the residue and the
+Jacobian allocates several temporary arrays for each pass over the
+interactions. When Numba is available, the loops here are compiled so that the
+exponential, the energy, the derivatives and the reduction for each
+configuration are all fused into a single pass over the flattened interactions
+without any temporary arrays.
+
+Numba is an optional dependency, :py:data:`HAS_NUMBA` tells if it can be used.
+
+"""
+
+import math
+
+import numpy as np
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def _residue_loop(dists, pot_idx, conf_idx, mp, ab_initio_e, res):
+
+    """Accumulates the residues of all the configurations in one pass"""
+
+    for i in range(res.shape[0]):
+        res[i] = -ab_initio_e[i]
+
+    for i in range(dists.shape[0]):
+        base = pot_idx[i] * 3
+        de = mp[base]
+        a = mp[base + 1]
+        r0 = mp[base + 2]
+        exp_m1 = math.exp(a * (r0 - dists[i])) - 1.0
+        res[conf_idx[i]] += de * (exp_m1 * exp_m1 - 1.0)
+
+
+def _jacobi_loop(dists, pot_idx, conf_idx, mp, jac):
+
+    """Accumulates the Jacobian of all the configurations in one pass"""
+
+    for i in range(jac.shape[0]):
+        for j in range(jac.shape[1]):
+            jac[i, j] = 0.0
+
+    for i in range(dists.shape[0]):
+        base = pot_idx[i] * 3
+        conf = conf_idx[i]
+        de = mp[base]
+        a = mp[base + 1]
+        r0 = mp[base + 2]
+        diff = r0 - dists[i]
+        exp_term = math.exp(a * diff)
+        exp_m1 = exp_term - 1.0
+        common = 2.0 * de * exp_term * exp_m1
+        jac[base, conf] += exp_m1 * exp_m1 - 1.0
+        jac[base + 1, conf] += common * diff
+        jac[base + 2, conf] += common * a
+
+
+if HAS_NUMBA:
+    _residue_loop = numba.njit(nogil=True)(_residue_loop)
+    _jacobi_loop = numba.njit(nogil=True)(_jacobi_loop)
+
+
+def gen_jit_rj_func(dists, pot_idx, conf_idx, ab_initio_e, n_pot):
+
+    """Generates the residue and Jacobian closures by the compiled loops
+
+    The arguments are the flattened arrays of the interactions as prepared in
+    :py:func:`morsefit.residue.gen_rj_func`, and the closures follow the same
+    convention as the ones from there. Without Numba, the loops are run as
+    plain Python, which is correct but very slow, so the callers should check
+    :py:data:`HAS_NUMBA` first.
+
+    """
+
+    dists = np.ascontiguousarray(np.asarray(dists), dtype=np.float64)
+    pot_idx = np.ascontiguousarray(np.asarray(pot_idx), dtype=np.intp)
+    conf_idx = np.ascontiguousarray(np.asarray(conf_idx), dtype=np.intp)
+    ab_initio_e = np.ascontiguousarray(
+            np.asarray(ab_initio_e), dtype=np.float64
+            )
+    m = len(ab_initio_e)
+    n = 3 * n_pot
+
+    def residue(mp):
+        res = np.empty(m, dtype=np.float64)
+        _residue_loop(
+                dists, pot_idx, conf_idx,
+                np.ascontiguousarray(mp, dtype=np.float64), ab_initio_e, res
+                )
+        return res
+
+    def jacobi(mp):
+        res = np.empty((n, m), dtype=np.float64)
+        _jacobi_loop(
+                dists, pot_idx, conf_idx,
+                np.ascontiguousarray(mp, dtype=np.float64), res
+                )
+        return res
+
+    return residue, jacobi
+
+
+def check_closures(residue, jacobi, ref_residue, ref_jacobi, mp,
+                   rtol=1.0E-10, atol=1.0E-12):
+
+    """Checks the closures against the reference closures at a point
+
+    :param residue: The residue closure to be checked.
+    :param jacobi: The Jacobian closure to be checked.
+    :param ref_residue: The reference residue closure.
+    :param ref_jacobi: The reference Jacobian closure.
+    :param mp: The vector of parameters to evaluate the closures at.
+    :return: If both the residue and the Jacobian agree with the reference.
+
+    """
+
+    return (
+            np.allclose(residue(mp), ref_residue(mp), rtol=rtol, atol=atol)
+            and np.allclose(jacobi(mp), ref_jacobi(mp), rtol=rtol, atol=atol)
+            )
@@ -27,7 +27,7 @@ def conv_residue(residue_closure, N, M):
 
     def norm_sq_closure(param):
         residues = residue_closure(param)
-        return sum(i_residue ** 2 for i_residue in residues)
+        return residues.dot(residues)
 
     return norm_sq_closure
 
@@ -46,19 +46,30 @@ def conv_jacobi(jacobi_closure, residue_closure, N, M):
     def jacobi_new(param):
         residue = residue_closure(param)
         jacobi = jacobi_closure(param)
-        result = np.empty(N, dtype=np.float64)
-        for i in xrange(0, N):
-            result[i] = sum(
-                    2 * residue[j] * jacobi[i][j] for j in xrange(0, M)
-                    )
-            continue
-        return result
+        return 2.0 * jacobi.dot(residue)
 
     return jacobi_new
 
 
+def conv_fun_grad(residue_closure, jacobi_closure, N, M):
 
+    """Converts the closures into one for both the objective and gradient
 
+    The returned closure gives the pair of the residue square and its gradient,
+    so that the residue and the Jacobian are just evaluated once for each
+    point. It can be used with the ``jac=True`` option of
+    :py:func:`scipy.optimize.minimize`.
 
+    :param func residue_closure: The closure for computing the residue vector.
+    :param func jacobi_closure: The closure for computing the Jacobian matrix.
+    :param int N: The number of parameters
+    :param int M: The number of residues
 
+    """
+
+    def fun_grad(param):
+        residue = residue_closure(param)
+        jacobi = jacobi_closure(param)
+        return residue.dot(residue), 2.0 * jacobi.dot(residue)
 
+    return fun_grad
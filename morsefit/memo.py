@@ -0,0 +1,116 @@
+"""Defines the memoization of the residue and Jacobian closures
+
+The optimizers and the driver frequently evaluate the residue and the Jacobian
+at exactly the same vector of parameters more than once, for instance after
+each trunk of optimization steps for printing. Here the closures can be wrapped
+in a small least-recently-used cache keyed on the bytes of the parameter
+vector, so that the repeated evaluations are free.
+
+"""
+
+import collections
+
+import numpy as np
+
+
+class MemoizedClosure(object):
+
+    """A closure of the parameter vector with its recent results cached
+
+    The results are keyed on the exact bytes of the parameter vector as double
+    precision floats, so that only the evaluations at exactly the same point
+    are reused. The cached arrays are marked read-only, since they are shared
+    between all the callers.
+
+    .. py:attribute:: closure
+
+      The underlying closure.
+
+    .. py:attribute:: max_size
+
+      The maximum number of results to be kept.
+
+    .. py:attribute:: hits
+
+      The number of evaluations that are served by the cache.
+
+    .. py:attribute:: misses
+
+      The number of evaluations that are forwarded to the closure.
+
+    """
+
+    __slots__ = [
+            "closure",
+            "max_size",
+            "hits",
+            "misses",
+            "_cache"
+            ]
+
+    def __init__(self, closure, max_size=4):
+
+        """Initializes the memoized closure
+
+        :param closure: The closure to be memoized.
+        :param int max_size: The maximum number of cached results.
+
+        """
+
+        self.closure = closure
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def __call__(self, param):
+
+        """Evaluates the closure, with cached results reused"""
+
+        key = np.ascontiguousarray(param, dtype=np.float64).tostring()
+
+        try:
+            value = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = self.closure(param)
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+            self.misses += 1
+            if len(self._cache) >= self.max_size:
+                self._cache.popitem(last=False)
+
+        # Put the result at the most-recently-used end.
+        self._cache[key] = value
+
+        return value
+
+    def clear(self):
+
+        """Drops all the cached results, the counters are kept"""
+
+        self._cache.clear()
+        return None
+
+
+def memoize_rj(residue, jacobi, max_size=4, jacobi_max_size=1):
+
+    """Memoizes the residue and Jacobian closures
+
+    The Jacobians are dense matrices of the number of parameters times the
+    number of configurations, so by default only the last one is kept.
+
+    :param residue: The residue closure from
+      :py:func:`morsefit.residue.gen_rj_func`.
+    :param jacobi: The Jacobian closure.
+    :param int max_size: The maximum number of residue vectors to be cached.
+    :param int jacobi_max_size: The maximum number of Jacobians to be cached.
+    :return: The pair of :py:class:`MemoizedClosure` for the residue and the
+      Jacobian.
+
+    """
+
+    return (
+            MemoizedClosure(residue, max_size),
+            MemoizedClosure(jacobi, jacobi_max_size)
+            )
@@ -2,6 +2,8 @@
 
 from math import exp
 
+import numpy as np
+
 def morse_e(r, mp):
 
     """Compute the energy according to Morse potential
@@ -42,3 +44,158 @@ def morse_d_r0(r, mp):
     return 2 * a * de * exp(a * (r0 - r)) * (
             exp(a * (r0 - r)) - 1 )
 
+
+
+#
+# Array-native kernels
+# --------------------
+#
+# The scalar functions above are convenient for a single distance, but the
+# exponential is recomputed for each of them. The kernels here work on whole
+# arrays of distances and share a single exponential between the energy and
+# all the derivatives.
+#
+
+def morse_fused(r, de, a, r0, out=None):
+
+    """Compute the Morse energy and all its derivatives in one pass
+
+    The distances and the parameters are given as arrays of the same shape, or
+    anything that can be broadcast against the distances. The exponential
+    :math:`\\exp(a (r_0 - r))` is evaluated only once for each distance, with
+    all the intermediate results written in place into the output buffer.
+
+    :param r: The array of distances.
+    :param de: The :math:`D_e` parameters for the distances.
+    :param a: The :math:`a` parameters for the distances.
+    :param r0: The :math:`r_0` parameters for the distances.
+    :param out: The optional :math:`4\\times{}K` output buffer for :math:`K`
+      distances. It must not overlap with any of the inputs.
+    :return: The array whose rows are the energy, and the partial derivatives
+      with respect to :math:`D_e`, :math:`a`, and :math:`r_0`.
+
+    """
+
+    if out is None:
+        out = np.empty((4, np.size(r)), dtype=np.float64)
+    energy, d_de, d_a, d_r0 = out
+
+    # r0 - r, and the exponential term
+    np.subtract(r0, r, out=d_r0)
+    np.multiply(a, d_r0, out=energy)
+    np.exp(energy, out=energy)
+    # exp - 1
+    np.subtract(energy, 1.0, out=d_de)
+    # 2 D_e exp (exp - 1), common to the derivatives wrt a and r0
+    np.multiply(energy, d_de, out=energy)
+    np.multiply(energy, de, out=energy)
+    np.multiply(energy, 2.0, out=energy)
+    np.multiply(energy, d_r0, out=d_a)
+    np.multiply(energy, a, out=d_r0)
+    # (exp - 1) ** 2 - 1, and the energy
+    np.multiply(d_de, d_de, out=d_de)
+    np.subtract(d_de, 1.0, out=d_de)
+    np.multiply(d_de, de, out=energy)
+
+    return out
+
+
+def morse_energy(r, de, a, r0, out=None):
+
+    """Compute the Morse energy for arrays of distances
+
+    The arguments are the same as :py:func:`morse_fused`, except that the
+    output buffer is just a 1-D array for the energies.
+
+    """
+
+    if out is None:
+        out = np.empty(np.size(r), dtype=np.float64)
+
+    np.subtract(r0, r, out=out)
+    np.multiply(a, out, out=out)
+    np.exp(out, out=out)
+    np.subtract(out, 1.0, out=out)
+    np.multiply(out, out, out=out)
+    np.subtract(out, 1.0, out=out)
+    np.multiply(out, de, out=out)
+
+    return out
+
+
+class MorseKernel(object):
+
+    """Evaluates the Morse terms of a fixed set of distances
+
+    The distances and the index of the Morse potential for each of them are
+    given at the initialization, together with preallocated buffers for the
+    gathered parameters and the results. So the evaluation for a new vector of
+    Morse parameters does not allocate any new array.
+
+    .. py:attribute:: dists
+
+      The array of distances.
+
+    .. py:attribute:: pot_idx
+
+      The index of the Morse potential for each distance.
+
+    """
+
+    __slots__ = [
+            "dists",
+            "pot_idx",
+            "_params",
+            "_out"
+            ]
+
+    def __init__(self, dists, pot_idx):
+
+        """Initializes the kernel
+
+        :param dists: The 1-D array of distances.
+        :param pot_idx: The 1-D integral array of indices of the Morse
+          potential for the distances, in the same order as the list of initial
+          guesses.
+
+        """
+
+        self.dists = np.ascontiguousarray(dists, dtype=np.float64)
+        self.pot_idx = np.ascontiguousarray(pot_idx, dtype=np.intp)
+        n_dists = len(self.dists)
+        self._params = np.empty((3, n_dists), dtype=np.float64)
+        self._out = np.empty((4, n_dists), dtype=np.float64)
+
+    def _gather(self, mp):
+
+        """Gathers the parameters for each of the distances"""
+
+        mp_mat = np.reshape(mp, (-1, 3))
+        for i in xrange(0, 3):
+            np.take(mp_mat[:, i], self.pot_idx, out=self._params[i])
+            continue
+        return self._params
+
+    def energy(self, mp):
+
+        """Computes the energies for the given grand vector of parameters
+
+        The returned array is a buffer of the kernel, which is going to be
+        overwritten by the next evaluation.
+
+        """
+
+        de, a, r0 = self._gather(mp)
+        return morse_energy(self.dists, de, a, r0, out=self._out[0])
+
+    def fused(self, mp):
+
+        """Computes the energies and derivatives for the given parameters
+
+        The result is the same as :py:func:`morse_fused`, in a buffer that is
+        going to be overwritten by the next evaluation.
+
+        """
+
+        de, a, r0 = self._gather(mp)
+        return morse_fused(self.dists, de, a, r0, out=self._out)
@@ -0,0 +1,148 @@
+"""Defines the multi-start global fitting
+
+The fits from a single initial guess often land in poor local minima. Here many
+starting vectors are sampled within the bounds of the parameters, and the fits
+from them are run concurrently in a pool of worker processes. The fits are
+advanced in rounds of a limited number of residue evaluations, with the worse
+half of the unfinished fits dropped after each round, so that little effort is
+wasted on the losing starts.
+
+The residue and Jacobian closures are shared with the workers by the forking
+of the process, so the interactions are never parsed or computed again in the
+workers.
+
+"""
+
+import numpy as np
+from numpy import linalg
+
+from .solvers import bounds_to_arrays, fit_trust_region
+from .workers import shared_pool
+
+
+def sample_starts(ig, bounds, n_starts, seed=None, spread=0.5):
+
+    """Samples the starting vectors by Latin hypercube sampling
+
+    For each parameter, the range between its bounds is divided into as many
+    strata as the number of starts, with each stratum sampled exactly once. For
+    a missing bound, the range extends from the initial guess by the given
+    fraction of its magnitude. The initial guess itself is always taken as the
+    first start.
+
+    :param ig: The initial guess of the parameters.
+    :param bounds: The list of pairs of bounds for the parameters.
+    :param int n_starts: The number of starts.
+    :param seed: The seed for the random number generator.
+    :param float spread: The relative spread around the initial guess for
+      the missing bounds.
+    :return: The :math:`K\\times{}N` array of starting vectors.
+
+    """
+
+    ig = np.asarray(ig, dtype=np.float64)
+    lower, upper = bounds_to_arrays(bounds)
+    width = spread * np.where(ig != 0.0, np.abs(ig), 1.0)
+    lower = np.where(np.isfinite(lower), lower, ig - width)
+    upper = np.where(np.isfinite(upper), upper, ig + width)
+
+    rand = np.random.RandomState(seed)
+    n_params = len(ig)
+    strata = np.array(
+            [ rand.permutation(n_starts) for i in xrange(0, n_params) ]
+            ).T
+    unit = (strata + rand.uniform(size=(n_starts, n_params))) / n_starts
+    starts = lower + unit * (upper - lower)
+
+    starts[0] = np.clip(ig, lower, upper)
+    return starts
+
+
+# The residue and Jacobian closures and the fitting options for the workers,
+# set before the pool is forked.
+_shared = {}
+
+
+def _advance_start(args):
+
+    """Advances the fit of one start by a limited number of evaluations"""
+
+    idx, param, max_nfev = args
+    residue = _shared['residue']
+    fit_result = fit_trust_region(
+            residue, _shared['jacobi'], param, _shared['bounds'],
+            method=_shared['method'], tol=_shared['tol'], max_nfev=max_nfev
+            )
+    return (
+            idx, fit_result.x, linalg.norm(residue(fit_result.x)),
+            fit_result.status > 0, fit_result.nfev
+            )
+
+
+def run_multistart(residue, jacobi, starts, bounds, method='TRF',
+                   tol=1.0E-8, round_nfev=100, max_rounds=10, jobs=1):
+
+    """Runs the fits from many starts with the losing starts dropped early
+
+    In each round, every unfinished fit is advanced by at most the given
+    number of residue evaluations with a trust-region method. Then the fits
+    that have converged are finished, and among the rest only the better half,
+    in terms of the residue norm, is kept for the next round. All the
+    unfinished fits are finished after the last round.
+
+    :param residue: The residue closure.
+    :param jacobi: The Jacobian closure, or None for finite differences.
+    :param starts: The array of starting vectors.
+    :param bounds: The list of pairs of bounds for the parameters.
+    :param method: The trust-region method, as in
+      :py:func:`morsefit.solvers.fit_trust_region`.
+    :param float tol: The tolerance for the fits.
+    :param int round_nfev: The number of residue evaluations of each fit in
+      each round.
+    :param int max_rounds: The maximum number of rounds.
+    :param int jobs: The number of worker processes.
+    :return: The list of the fits, given as tuples of the index of the start,
+      the parameters, the residue norm, whether it has converged, the number of
+      residue evaluations spent on it, and the number of the rounds it has
+      survived. The list is sorted by the residue norm.
+
+    """
+
+    fits = dict(
+            (i, (i, v, np.inf, False, 0, 0)) for i, v in enumerate(starts)
+            )
+    active = sorted(fits.keys())
+
+    with shared_pool(_shared, {
+            'residue': residue,
+            'jacobi': jacobi,
+            'bounds': bounds,
+            'method': method,
+            'tol': tol
+            }, jobs) as mapper:
+
+        for i_round in xrange(0, max_rounds):
+
+            results = mapper(_advance_start, [
+                (i, fits[i][1], round_nfev) for i in active
+                ])
+
+            for idx, param, norm, succ, nfev in results:
+                fits[idx] = (
+                        idx, param, norm, succ, fits[idx][4] + nfev,
+                        i_round + 1
+                        )
+                continue
+
+            # Finish the converged, and keep the better half of the others.
+            active = sorted(
+                    (i[0] for i in results if not i[3]),
+                    key=lambda x: fits[x][2]
+                    )
+            if i_round + 1 < max_rounds:
+                active = active[:(len(active) + 1) // 2]
+            if len(active) == 0:
+                break
+            continue
+
+    return sorted(fits.values(), key=lambda x: x[2])
@@ -0,0 +1,180 @@
+"""Defines the instrumentation of the fitting
+
+Two facilities are given here. The :py:class:`Profiler` accumulates the wall
+time and the number of calls of named phases, like the parsing of the input,
+the resolution of the interactions, and the evaluations of the residue and the
+Jacobian. A global profiler :py:data:`PROFILER` is used throughout the code.
+The :py:class:`Telemetry` streams a record for each iteration of the
+optimization as a JSON line into a file, so that long fits can be watched
+while they are running.
+
+"""
+
+import sys
+import time
+import json
+import contextlib
+
+
+class Profiler(object):
+
+    """Accumulates the wall times and the call counts of named phases
+
+    .. py:attribute:: times
+
+      The dictionary of the total wall time in seconds for each phase.
+
+    .. py:attribute:: counts
+
+      The dictionary of the number of calls for each phase.
+
+    """
+
+    __slots__ = [
+            "times",
+            "counts"
+            ]
+
+    def __init__(self):
+
+        """Initializes an empty profiler"""
+
+        self.times = {}
+        self.counts = {}
+
+    def add(self, name, elapsed, count=1):
+
+        """Adds the wall time and the calls to a phase"""
+
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+        self.counts[name] = self.counts.get(name, 0) + count
+        return None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+
+        """Times the body of a ``with`` statement as a call of a phase"""
+
+        begin = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - begin)
+
+    def wrap(self, name, func):
+
+        """Wraps a function so that each call is timed as a call of a phase"""
+
+        def timed(*args, **kwargs):
+            begin = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.time() - begin)
+
+        return timed
+
+    def snapshot(self):
+
+        """Gets the times and counts as plain dictionaries"""
+
+        return dict(self.times), dict(self.counts)
+
+    def merge(self, snapshot):
+
+        """Merges the snapshot of another profiler, like from a worker"""
+
+        times, counts = snapshot
+        for name in times:
+            self.add(name, times[name], counts.get(name, 0))
+            continue
+        return None
+
+    def clear(self):
+
+        """Clears all the records"""
+
+        self.times.clear()
+        self.counts.clear()
+        return None
+
+    def report(self, out=sys.stdout):
+
+        """Prints the table of the recorded phases"""
+
+        print >> out, " %25s %15s %10s %15s " % (
+                "Phase", "Time (s)", "Calls", "Per call (s)"
+                )
+        for name in sorted(self.times.keys()):
+            count = self.counts[name]
+            print >> out, " %25s %15.6f %10d %15.6f " % (
+                    name, self.times[name], count,
+                    self.times[name] / count if count > 0 else 0.0
+                    )
+            continue
+        return None
+
+
+# The global profiler
+PROFILER = Profiler()
+
+
+class Telemetry(object):
+
+    """Streams the records of the iterations as JSON lines
+
+    Each record contains the number of the iteration, the wall time since the
+    beginning, the wall time of the step since the last record, the residue
+    norm and the parameters, along with any additional fields. The file is
+    flushed after each record.
+
+    """
+
+    __slots__ = [
+            "out",
+            "n_iter",
+            "_begin",
+            "_last"
+            ]
+
+    def __init__(self, file_name):
+
+        """Initializes the telemetry to be written into a file"""
+
+        self.out = open(file_name, 'w')
+        self.n_iter = 0
+        self._begin = time.time()
+        self._last = self._begin
+
+    def record(self, param, residue_norm, **extra):
+
+        """Writes the record of an iteration
+
+        :param param: The current vector of parameters.
+        :param float residue_norm: The current residue norm.
+        :param extra: Any additional fields of the record.
+
+        """
+
+        now = time.time()
+        rec = {
+                'iteration': self.n_iter,
+                'time': now - self._begin,
+                'step_time': now - self._last,
+                'residue': float(residue_norm),
+                'params': [ float(i) for i in param ]
+                }
+        rec.update(extra)
+        print >> self.out, json.dumps(rec, sort_keys=True)
+        self.out.flush()
+
+        self.n_iter += 1
+        self._last = now
+        return None
+
+    def close(self):
+
+        """Closes the file"""
+
+        self.out.close()
+        return None
@@ -1,117 +1,440 @@
 """Defines the residue and Jacobian function generators"""
 
+import os
 import sys
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
+from scipy import sparse
 
-from .morse import *
+from .configuration import ConfigurationSet
+from .morse import MorseKernel
+from . import jit
 
-def get_mp_base_idx(morse, elem_pair):
 
-    """Gets the base index for the Morse parameters for a given element pair
+def gen_pot_table(morse):
 
-    Since the Morse parameters for all the element pairs are stored in a big
-    vector, we need to compute the base index for the Morse parameters for a
-    given element pair. The protocol is fairly simple, just the :math:`D_e`,
-    :math:`a`, and :math:`r_0` parameters of each pair in the Morse potential
-    list are stored consecutively in the same order as the list for the initial
-    guess.
+    """Generates the interning table of the element pairs of the potentials
 
-    :param morse: The list of initial guesses for the Morse potential, as
-        returned from the :py:func:`read_morse_inp` function.
-    :param elem_pair: A pair of element symbols.
+    The Morse parameters for all the element pairs are stored in a big vector,
+    with the :math:`D_e`, :math:`a`, and :math:`r_0` parameters of each pair
+    stored consecutively in the same order as the list of initial guesses. So
+    the parameters of the potential with index ``i`` in the table begin at
+    ``3 * i`` in the vector.
+
+    :param morse: The list of initial guesses for the Morse potential.
+    :return: The dictionary from the sorted pairs of element symbols to the
+      index of the Morse potential in the list. For duplicated pairs, the
+      first guess is used.
+
+    """
+
+    table = {}
+    for i, v in enumerate(morse):
+        elem_pair = tuple(sorted(v[0]))
+        if elem_pair in table:
+            print "Multiple guesses are given for %s and %s!" % elem_pair
+            continue
+        table[elem_pair] = i
+        continue
+
+    return table
 
-    .. warning.. 
 
-      It will abort the program if the initial guess for the element pair is not
-      given.
+def gen_pot_lookup(morse, elements):
+
+    """Generates the lookup array of the potentials for pairs of elements
+
+    The lookup is built once for the interned element symbols, so that the
+    potential for a pair of element codes is found by a simple indexing
+    rather than a scan of the list of the guesses.
+
+    :param morse: The list of initial guesses for the Morse potential.
+    :param elements: The list of the interned element symbols.
+    :return: The symmetric :math:`E\\times{}E` array of the index of the Morse
+      potential for each pair of element codes, with -1 for the pairs without
+      guesses.
 
     """
 
-    elem_pair_s = tuple(sorted(elem_pair))
-    idx_found = [ i for i, v in enumerate(morse) if v[0] == elem_pair_s ]
+    table = gen_pot_table(morse)
+    n_elems = len(elements)
+    lookup = np.empty((n_elems, n_elems), dtype=np.intp)
+    lookup.fill(-1)
 
-    if len(idx_found) < 1:
-        print "Morse potential guess for %s and %s is not given!" % elem_pair
-        sys.exit(1)
-    elif len(idx_found) > 1:
-        print "Multiple guesses are given for %s and %s!" % elem_pair
-    else:
-        pair_idx = idx_found[0]
+    for i in xrange(0, n_elems):
+        for j in xrange(i, n_elems):
+            lookup[i, j] = lookup[j, i] = table.get(
+                    tuple(sorted((elements[i], elements[j]))), -1
+                    )
+            continue
+        continue
+
+    return lookup
+
+
+def get_pot_of_pair(morse, conf_set):
+
+    """Gets the index of the Morse potential for each pair type of a set
+
+    :param morse: The list of initial guesses for the Morse potential.
+    :param conf_set: The :py:class:`ConfigurationSet` with the interactions
+      calculated.
+    :return: The array of the index of the potential for each of the pair
+      types of the set.
+
+    .. warning::
+
+      It will abort the program if the initial guess is not given for any of
+      the pair types.
+
+    """
+
+    lookup = gen_pot_lookup(morse, conf_set.elements)
+    elem_codes = dict((v, i) for i, v in enumerate(conf_set.elements))
+
+    pot_of_pair = np.empty(len(conf_set.pair_types), dtype=np.intp)
+    for i, elem_pair in enumerate(conf_set.pair_types):
+        pot_of_pair[i] = lookup[
+                elem_codes[elem_pair[0]], elem_codes[elem_pair[1]]
+                ]
+        if pot_of_pair[i] < 0:
+            print "Morse potential guess for %s and %s is not given!" % (
+                    tuple(elem_pair)
+                    )
+            sys.exit(1)
+        continue
 
-    return pair_idx * 3
+    return pot_of_pair
 
 
 
-def gen_rj_func(confs, morse):
+def gen_rj_func(confs, morse, dedup_tol=None, backend='numpy', threads=1):
 
     """Generate the residue and Jacobian function for a list of configurations
 
     It returns two functions that is able to return the residue and the
     Jacobian respectively when called with the grand vector of Morse parameters
-    of the protocol as defined in the function :py:func:`get_mp_base_idx`. For
+    of the protocol as defined in the function :py:func:`gen_pot_table`. For
     a :math:`N` parameter and :math:`M` configuration problem, the residue
     function is going to return a 1-D array of length M for the residues. For
     the Jacobian, the return value is going to be an :math:`N\\times{}M`
     matrix.
 
-    :param confs: The list of configurations.
+    All the interactions in all the configurations are taken as contiguous
+    arrays of the distance, the index of the Morse potential and the index of
+    the owning configuration, so that the closures can evaluate the Morse terms
+    by array operations and sum them up for each configuration by segmented
+    reductions.
+
+    :param confs: The :py:class:`ConfigurationSet`, or a list of
+      configurations which is going to be converted into one.
     :param morse: The list of initial guesses for the Morse potential.
+    :param dedup_tol: The tolerance for merging duplicated distances by
+      :py:func:`compress_interactions`, zero for merging only identical
+      distances. By default no merging is performed.
+    :param backend: The backend for the evaluation, ``numpy`` for the array
+      kernels, or ``numba`` for the compiled loops in :py:mod:`morsefit.jit`.
+      It falls back to ``numpy`` when Numba is not installed, and the merging
+      of distances is only supported by ``numpy``.
+    :param int threads: The number of threads, with the configurations split
+      into shards of similar numbers of interactions evaluated concurrently.
+      It is only supported by the ``numpy`` backend without merging.
 
     """
 
+    if not isinstance(confs, ConfigurationSet):
+        confs = ConfigurationSet.from_configurations(confs)
+
     # The vector of ab-initio energies
-    ab_initio_e = np.array([i.ab_initio_e for i in confs ])
-
-    # For each configuration, a list of (base index for Morse parameters,
-    # distance) pairs for all the interactions that is accounted.
-    interactions_w_base_idx = [
-            [
-                (get_mp_base_idx(morse, i[0]), i[1]) 
-                for i in i_conf.interactions ]
-            for i_conf in confs ]
-
-    # For each configuration, a list of distances for each Morse parameters, in
-    # the same order as given in the list ``morse``.
-    base_idx_w_dist = [
-            [
-                [ i[1] for i in i_conf if i[0] == i_pot * 3 ]
-                for i_pot in xrange(0, len(morse)) ]
-            for i_conf in interactions_w_base_idx ]
+    ab_initio_e = confs.ab_initio_e
 
     # n parameter, m residue, the same as the convention in the documentation
     # of leastsq of scipy
-    n = 3 * len(morse)
+    n_pot = len(morse)
+    n = 3 * n_pot
     m = len(confs)
 
+    # The interactions of all the configurations are already flattened in the
+    # configuration set, with the pair types interned. So the potential index
+    # of every interaction is found by a single indexing pass.
+    dists = confs.dists
+    pot_idx = get_pot_of_pair(morse, confs)[confs.pair_codes]
+    conf_idx = confs.conf_index()
+
+    if backend == 'numba':
+        if not jit.HAS_NUMBA:
+            print "Numba is not installed, the numpy backend is used..."
+        elif dedup_tol is not None:
+            print "Merging distances needs the numpy backend, which is used..."
+        else:
+            return jit.gen_jit_rj_func(
+                    dists, pot_idx, conf_idx, ab_initio_e, n_pot
+                    )
+    elif backend != 'numpy':
+        print "Unknown backend %s!" % backend
+        sys.exit(1)
+
+    if dedup_tol is not None:
+        if threads > 1:
+            print "Merging distances is not threaded, one thread is used..."
+        return _gen_dedup_rj_func(
+                dists, pot_idx, conf_idx, ab_initio_e, n_pot, dedup_tol
+                )
+
+    if threads > 1 and m > 1:
+        return _gen_sharded_rj_func(
+                dists, pot_idx, confs.inter_offsets, ab_initio_e, n_pot,
+                threads
+                )
+
+    # The kernel evaluating the Morse terms for all the distances, with its
+    # own preallocated buffers.
+    kernel = MorseKernel(dists, pot_idx)
+
+    # The segment index for the Jacobian reduction, with the rows of the
+    # potentials and the columns of the configurations.
+    jacobi_idx = pot_idx * m + conf_idx
+
     # The residue closure to be returned
     def residue(mp):
-        # Use iteration to boost performance
-        res = np.empty(m, dtype=np.float64)
-        for i in xrange(0, m):
-            # Use iterator
-            res[i] = sum(
-                    morse_e(i_term[1], mp[i_term[0]:(i_term[0] + 3)])
-                    for i_term in interactions_w_base_idx[i] ) - ab_initio_e[i]
+        return np.bincount(
+                conf_idx, weights=kernel.energy(mp), minlength=m
+                ) - ab_initio_e
+
+    def jacobi(mp):
+        terms = kernel.fused(mp)
+        res = np.empty((n_pot, 3, m), dtype=np.float64)
+        for i_param in xrange(0, 3):
+            res[:, i_param, :] = np.bincount(
+                    jacobi_idx, weights=terms[i_param + 1],
+                    minlength=n_pot * m
+                    ).reshape((n_pot, m))
             continue
+        return res.reshape((n, m))
+
+    return residue, jacobi
+
+
+def compress_interactions(dists, pot_idx, conf_idx, m, tol=0.0):
+
+    """Collapses the duplicated interactions into unique ones with weights
+
+    The interactions with the same Morse potential and the same distance,
+    within or across configurations, are merged into a single unique
+    interaction. With a positive tolerance, the distances falling into the
+    same bin of width of the tolerance are merged, with the mean of the
+    distances used for the unique interaction.
+
+    :param dists: The array of distances of the interactions.
+    :param pot_idx: The array of the Morse potential index of the interactions.
+    :param conf_idx: The array of configuration index of the interactions.
+    :param int m: The number of configurations.
+    :param float tol: The tolerance for merging the distances.
+    :return: The array of the distances of the unique interactions, the array
+      of their Morse potential index, and the sparse :math:`M\\times{}U`
+      incidence matrix of the :math:`U` unique interactions in the
+      configurations, whose entries are the multiplicities.
+
+    """
+
+    if tol > 0:
+        keys = np.floor(np.asarray(dists) / tol).astype(np.int64)
+    else:
+        keys = np.asarray(dists)
+
+    order = np.lexsort((keys, pot_idx))
+    sorted_keys = keys[order]
+    sorted_pots = pot_idx[order]
+    new_group = np.empty(len(order), dtype=np.bool_)
+    new_group[:1] = True
+    new_group[1:] = (
+            (sorted_keys[1:] != sorted_keys[:-1])
+            | (sorted_pots[1:] != sorted_pots[:-1])
+            )
+    group_of_sorted = np.cumsum(new_group) - 1
+    n_unique = int(group_of_sorted[-1]) + 1 if len(order) > 0 else 0
+
+    group = np.empty(len(order), dtype=np.intp)
+    group[order] = group_of_sorted
+    counts = np.bincount(group, minlength=n_unique)
+    unique_dists = np.bincount(
+            group, weights=dists, minlength=n_unique
+            ) / np.maximum(counts, 1)
+    unique_pots = sorted_pots[new_group]
+
+    incidence = sparse.coo_matrix(
+            (np.ones(len(group), dtype=np.float64), (conf_idx, group)),
+            shape=(m, n_unique)
+            ).tocsr()
+
+    return unique_dists, unique_pots, incidence
+
+
+def _gen_dedup_rj_func(dists, pot_idx, conf_idx, ab_initio_e, n_pot, tol):
+
+    """Generates the residue and Jacobian closures with merged interactions
+
+    The Morse terms are just evaluated for the unique interactions from
+    :py:func:`compress_interactions`, and scattered back into the
+    configurations through the incidence matrix.
+
+    """
+
+    m = len(ab_initio_e)
+    n = 3 * n_pot
+
+    dists, pot_idx, incidence = compress_interactions(
+            dists, pot_idx, conf_idx, m, tol
+            )
+    kernel = MorseKernel(dists, pot_idx)
+
+    # The sparsity structure of the derivatives of the unique interactions
+    # with respect to all the parameters, with three parameters for each.
+    n_unique = len(dists)
+    deriv_indptr = np.arange(0, 3 * n_unique + 1, 3)
+    deriv_indices = (pot_idx[:, None] * 3 + np.arange(3)).ravel()
+
+    def residue(mp):
+        return incidence.dot(kernel.energy(mp)) - ab_initio_e
+
+    def jacobi(mp):
+        terms = kernel.fused(mp)
+        derivs = sparse.csr_matrix(
+                (terms[1:].T.ravel(), deriv_indices, deriv_indptr),
+                shape=(n_unique, n)
+                )
+        return incidence.dot(derivs).T.toarray()
+
+    return residue, jacobi
+
+
+def split_shards(inter_offsets, n_shards):
+
+    """Splits the configurations into shards of similar numbers of interactions
+
+    :param inter_offsets: The offsets of the configurations into the array of
+      interactions, as in :py:class:`ConfigurationSet`.
+    :param int n_shards: The requested number of shards.
+    :return: The array of the boundaries of the shards in the configurations,
+      with the configurations of shard ``i`` being ``bounds[i]`` up to
+      ``bounds[i + 1]``. Empty shards are dropped.
+
+    """
+
+    inter_offsets = np.asarray(inter_offsets)
+    m = len(inter_offsets) - 1
+    targets = inter_offsets[-1] * np.arange(1, n_shards) // n_shards
+    bounds = np.concatenate((
+        [0], np.searchsorted(inter_offsets, targets), [m]
+        ))
+    return np.unique(np.clip(bounds, 0, m))
+
+
+# The pool of threads shared by all the sharded closures, so that no pool is
+# left behind by the closures that are replaced. It is created lazily for each
+# process, since the threads are not carried over into the worker processes
+# forked for the multi-start fits and the cross-validation.
+_thread_pool = {}
+
+
+def _get_thread_pool(threads):
+
+    """Gets the shared pool of threads with at least the given size
+
+    The pool is terminated by :py:mod:`multiprocessing` at the exit of the
+    process, and a smaller pool of the same process is closed when it is
+    replaced by a larger one.
+
+    """
+
+    pid = os.getpid()
+    if _thread_pool.get('pid') == pid and _thread_pool['size'] >= threads:
+        return _thread_pool['pool']
+
+    if _thread_pool.get('pid') == pid:
+        _thread_pool['pool'].close()
+        _thread_pool['pool'].join()
+    _thread_pool.update({
+        'pid': pid,
+        'size': threads,
+        'pool': ThreadPool(threads)
+        })
+    return _thread_pool['pool']
+
+
+def _gen_sharded_rj_func(dists, pot_idx, inter_offsets, ab_initio_e, n_pot,
+                         threads):
+
+    """Generates the residue and Jacobian closures evaluated by threads
+
+    The configurations are split into contiguous shards by
+    :py:func:`split_shards`, each with its own kernel over its slice of the
+    interactions. For each evaluation, the shards are evaluated on the shared
+    pool of threads, and each shard writes its residue entries and its
+    Jacobian columns directly into the output arrays allocated for the call.
+    Only the element-wise evaluation of the kernels runs in parallel, where
+    NumPy releases the GIL, while the reductions by ``np.bincount`` into the
+    configurations hold it.
+
+    """
+
+    m = len(ab_initio_e)
+    n = 3 * n_pot
+    bounds = split_shards(inter_offsets, threads)
+
+    shards = []
+    for conf_begin, conf_end in zip(bounds[:-1], bounds[1:]):
+        inter_begin = inter_offsets[conf_begin]
+        inter_end = inter_offsets[conf_end]
+        m_shard = conf_end - conf_begin
+        local_idx = np.repeat(
+                np.arange(m_shard),
+                np.diff(inter_offsets[conf_begin:conf_end + 1])
+                )
+        shard_pots = pot_idx[inter_begin:inter_end]
+        shards.append((
+            conf_begin, conf_end,
+            MorseKernel(dists[inter_begin:inter_end], shard_pots),
+            local_idx, shard_pots * m_shard + local_idx
+            ))
+        continue
+
+    def run_shards(func):
+        _get_thread_pool(len(shards)).map(func, shards, chunksize=1)
+        return None
+
+    def residue(mp):
+        res = np.empty(m, dtype=np.float64)
+
+        def eval_shard(shard):
+            conf_begin, conf_end, kernel, local_idx, jacobi_idx = shard
+            res[conf_begin:conf_end] = np.bincount(
+                    local_idx, weights=kernel.energy(mp),
+                    minlength=conf_end - conf_begin
+                    )
+            return None
+
+        run_shards(eval_shard)
+        res -= ab_initio_e
         return res
 
     def jacobi(mp):
-        res = np.empty((n, m), dtype = np.float64)
-        # Column major iteration
-        for i_conf in xrange(0, m):
-            for i_pot in xrange(0, len(morse)):
-                dists = base_idx_w_dist[i_conf][i_pot]
-                cur_param = mp[i_pot * 3:(i_pot + 1) * 3]
-                partial_de = sum(morse_d_de(i_r, cur_param) for i_r in dists)
-                partial_a = sum(morse_d_a(i_r, cur_param) for i_r in dists)
-                partial_r0 = sum(morse_d_r0(i_r, cur_param) for i_r in dists)
-                res[i_pot * 3, i_conf] = partial_de
-                res[i_pot * 3 + 1, i_conf] = partial_a
-                res[i_pot * 3 + 2, i_conf] = partial_r0
+        res = np.empty((n_pot, 3, m), dtype=np.float64)
+
+        def eval_shard(shard):
+            conf_begin, conf_end, kernel, local_idx, jacobi_idx = shard
+            m_shard = conf_end - conf_begin
+            terms = kernel.fused(mp)
+            for i_param in xrange(0, 3):
+                res[:, i_param, conf_begin:conf_end] = np.bincount(
+                        jacobi_idx, weights=terms[i_param + 1],
+                        minlength=n_pot * m_shard
+                        ).reshape((n_pot, m_shard))
                 continue
-            continue
-        return res
+            return None
 
-    return residue, jacobi
+        run_shards(eval_shard)
+        return res.reshape((n, m))
 
+    return residue, jacobi
@@ -0,0 +1,212 @@
+"""Defines the persistent fit sessions for incremental fitting
+
+When new ab-initio points keep arriving in batches, fitting the whole data set
+from scratch each time wastes most of the time on parsing the configurations
+that have been seen before and on converging from the initial guesses again. A
+fit session is a directory holding the configuration set with its
+interactions, in the format of :py:meth:`ConfigurationSet.save`, the list of
+files it has been read from, and the parameters and the state of the last fit.
+So only the new files need to be parsed and appended to the set, and the refit
+can be started from the previous optimum.
+
+"""
+
+import os
+import json
+import shutil
+import tempfile
+
+import numpy as np
+
+from .configuration import ConfigurationSet
+from .cache import gen_cache_key
+
+
+# The names of the parts of a session directory
+SESSION_FILE = 'session.json'
+PARAMS_FILE = 'params.npy'
+CONFS_DIR = 'confs'
+
+
+class Session(object):
+
+    """A fit session
+
+    .. py:attribute:: conf_set
+
+      The configuration set of all the configurations fitted.
+
+    .. py:attribute:: files
+
+      The list of the absolute path, the modification time and the size of
+      each of the files that the set has been read from, in the same format as
+      in :py:func:`morsefit.cache.gen_cache_key`.
+
+    .. py:attribute:: cut_off
+
+      The cut-off for the interactions.
+
+    .. py:attribute:: pairs
+
+      The list of the element pairs of the Morse potentials, in the order of
+      the parameters.
+
+    .. py:attribute:: params
+
+      The vector of the fitted parameters, None if it has not been fitted.
+
+    .. py:attribute:: state
+
+      The dictionary of the state of the last fit, like the method, the number
+      of function calls, the residue norm and if it has converged.
+
+    """
+
+    __slots__ = [
+            "conf_set",
+            "files",
+            "cut_off",
+            "pairs",
+            "params",
+            "state"
+            ]
+
+    def __init__(self, conf_set, files, cut_off, pairs, params=None,
+                 state=None):
+
+        """Initializes a session"""
+
+        self.conf_set = conf_set
+        self.files = files
+        self.cut_off = cut_off
+        self.pairs = pairs
+        self.params = params
+        self.state = state if state is not None else {}
+
+    def split_files(self, file_names):
+
+        """Splits the given files into the new and the changed ones
+
+        :param file_names: The list of names of the configuration files.
+        :return: The list of the names of the files that are not in the
+          session, and the list of the names of the files that are in the
+          session but have been modified since they were read.
+
+        """
+
+        known = dict((i[0], i[1:]) for i in self.files)
+        new_files = []
+        changed_files = []
+        for name, info in zip(
+                file_names, gen_cache_key(file_names, None)['files']
+                ):
+            if info[0] not in known:
+                new_files.append(name)
+            elif list(known[info[0]]) != info[1:]:
+                changed_files.append(name)
+            continue
+
+        return new_files, changed_files
+
+    def append(self, file_names, conf_set):
+
+        """Appends the configurations read from the given files
+
+        :param file_names: The list of names of the new configuration files.
+        :param conf_set: The configuration set read from the new files, with
+          the interactions calculated with the cut-off of the session.
+
+        """
+
+        self.conf_set = ConfigurationSet.concatenate([self.conf_set, conf_set])
+        self.files.extend(gen_cache_key(file_names, None)['files'])
+        return None
+
+    def warm_start(self, morse_guess):
+
+        """Gets the initial guess from the last fit
+
+        :param morse_guess: The list of initial guesses for the Morse
+          potential.
+        :return: The vector of the fitted parameters if the session has been
+          fitted for the same element pairs, or None otherwise.
+
+        """
+
+        if self.params is None:
+            return None
+        if self.pairs != [ list(i[0]) for i in morse_guess ]:
+            return None
+        return np.array(self.params, dtype=np.float64)
+
+
+def load_session(dir_name, mmap=True):
+
+    """Loads a session from a directory
+
+    :param dir_name: The directory of the session.
+    :param mmap: If the arrays of the configuration set are going to be memory
+      mapped.
+    :return: The loaded session, or None if it does not exist or is corrupt.
+
+    """
+
+    try:
+        with open(os.path.join(dir_name, SESSION_FILE)) as session_file:
+            meta = json.load(session_file)
+        conf_set = ConfigurationSet.load(
+                os.path.join(dir_name, CONFS_DIR), mmap=mmap
+                )
+    except (IOError, ValueError):
+        return None
+
+    params_name = os.path.join(dir_name, PARAMS_FILE)
+    params = np.load(params_name) if os.path.isfile(params_name) else None
+
+    return Session(
+            conf_set, meta['files'], meta['cut_off'],
+            [ list(i) for i in meta['pairs'] ], params, meta['state']
+            )
+
+
+def save_session(dir_name, session):
+
+    """Saves a session into a directory
+
+    The session is written into a temporary directory beside the target first
+    and then moved into place, so that an interrupted run never leaves a
+    corrupt session behind.
+
+    :param dir_name: The directory of the session, which is replaced.
+    :param session: The session to be saved.
+
+    """
+
+    dir_name = os.path.abspath(dir_name)
+    parent = os.path.dirname(dir_name)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    tmp_name = tempfile.mkdtemp(dir=parent)
+    session.conf_set.save(os.path.join(tmp_name, CONFS_DIR))
+    if session.params is not None:
+        np.save(os.path.join(tmp_name, PARAMS_FILE), session.params)
+    with open(os.path.join(tmp_name, SESSION_FILE), 'w') as session_file:
+        json.dump({
+            'files': session.files,
+            'cut_off': session.cut_off,
+            'pairs': session.pairs,
+            'state': session.state
+            }, session_file, indent=2, sort_keys=True)
+
+    # The old session is moved aside before the new one is moved in.
+    old_name = None
+    if os.path.isdir(dir_name):
+        old_name = tempfile.mkdtemp(dir=parent)
+        os.rmdir(old_name)
+        os.rename(dir_name, old_name)
+    os.rename(tmp_name, dir_name)
+    if old_name is not None:
+        shutil.rmtree(old_name)
+
+    return None
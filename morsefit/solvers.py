@@ -0,0 +1,200 @@
+"""Defines the solver backends for the fitting
+
+Besides the Levenberg-Marquardt solver from :py:func:`scipy.optimize.leastsq`
+and the general minimizers from :py:func:`scipy.optimize.minimize`, which are
+driven directly by the driver in trunks of steps, the backends here run the
+whole optimization in a single call, so that the internal state of the solver
+is never thrown away.
+
+"""
+
+import numpy as np
+from scipy import optimize
+
+
+# The trust-region least-square methods, with the method names for the driver
+# mapped to the names in scipy.
+TRUST_REGION_METHODS = {
+        'TRF': 'trf',
+        'dogbox': 'dogbox'
+        }
+
+
+def bounds_to_arrays(bounds):
+
+    """Converts the list of bound pairs into the arrays of bounds
+
+    :param bounds: The list of pairs of the lower and upper bound for each
+      parameter, with None for no bound.
+    :return: The arrays of the lower and the upper bounds, with the missing
+      bounds given as infinities.
+
+    """
+
+    lower = np.array(
+            [ -np.inf if i[0] is None else i[0] for i in bounds ],
+            dtype=np.float64
+            )
+    upper = np.array(
+            [ np.inf if i[1] is None else i[1] for i in bounds ],
+            dtype=np.float64
+            )
+
+    return lower, upper
+
+
+def fit_trust_region(residue, jacobi, ig, bounds, method='TRF', tol=1.0E-8,
+                     max_nfev=None, callback=None):
+
+    """Fits the parameters by a trust-region least-square method
+
+    The fit is performed by :py:func:`scipy.optimize.least_squares`, which
+    handles the bounds on the parameters natively. Since the Jacobian is
+    evaluated once for each iteration of the solver, the callback is invoked
+    along with the evaluation of the Jacobian for the progress of the
+    optimization.
+
+    :param residue: The residue closure.
+    :param jacobi: The Jacobian closure, giving the :math:`N\\times{}M`
+      matrix, or None for the finite-difference approximation.
+    :param ig: The initial guess of the parameters, which is going to be
+      clipped into the bounds.
+    :param bounds: The list of pairs of bounds for each of the parameters.
+    :param method: The name of the method, as a key of
+      :py:data:`TRUST_REGION_METHODS`.
+    :param float tol: The tolerance for the change of the cost function.
+    :param int max_nfev: The maximum number of residue evaluations.
+    :param callback: The function to be called with the number of iterations
+      and the current parameters for each iteration. It is only invoked when
+      the analytic Jacobian is used.
+    :return: The :py:class:`scipy.optimize.OptimizeResult` from the solver,
+      with the number of evaluations of the residue and the Jacobian in the
+      ``nfev`` and ``njev`` fields.
+
+    """
+
+    lower, upper = bounds_to_arrays(bounds)
+    x0 = np.clip(ig, lower, upper)
+
+    if jacobi is None:
+        jac = '2-point'
+    else:
+        n_iter = [0]
+
+        def jac(param):
+            if callback is not None:
+                callback(n_iter[0], param)
+            n_iter[0] += 1
+            return np.ascontiguousarray(jacobi(param).T)
+
+    return optimize.least_squares(
+            residue, x0, jac=jac, bounds=(lower, upper),
+            method=TRUST_REGION_METHODS[method], ftol=tol, max_nfev=max_nfev
+            )
+
+
+# The name of the Levenberg-Marquardt method on the streamed normal equations
+NORMAL_EQUATIONS_METHOD = 'NLM'
+
+
+def fit_normal_equations(normal_equations, residue, ig, bounds, tol=1.0E-8,
+                         max_iter=1000, callback=None):
+
+    """Fits the parameters by Levenberg-Marquardt on the normal equations
+
+    Rather than working on the :math:`N\\times{}M` Jacobian, the solver only
+    needs the :math:`N\\times{}N` matrix :math:`J J^T` and the vector
+    :math:`J r`, which can be accumulated in a streaming way over the
+    configurations, for instance by
+    :py:meth:`morsefit.blocked.BlockedEvaluator.normal_equations`. So the
+    memory is independent of the number of configurations.
+
+    In each iteration, the damped system with the Marquardt scaling by the
+    diagonal is solved for the step, which is projected into the bounds. The
+    parameters on a bound with the gradient pointing out of the bounds are
+    held fixed in the system. The step is accepted when the residue square
+    decreases, with the damping updated from the ratio of the actual and the
+    predicted decrease.
+
+    :param normal_equations: The function giving the residue square, the
+      matrix :math:`J J^T` and the vector :math:`J r` for the parameters.
+    :param residue: The residue closure, for testing the trial steps.
+    :param ig: The initial guess of the parameters, which is going to be
+      clipped into the bounds.
+    :param bounds: The list of pairs of bounds for each of the parameters.
+    :param float tol: The tolerance for the relative change of the residue
+      square and of the parameters.
+    :param int max_iter: The maximum number of iterations.
+    :param callback: The function to be called with the number of iterations
+      and the current parameters after each accepted step.
+    :return: The :py:class:`scipy.optimize.OptimizeResult`, with the number
+      of evaluations of the residue and of the normal equations in the
+      ``nfev`` and ``njev`` fields.
+
+    """
+
+    lower, upper = bounds_to_arrays(bounds)
+    param = np.clip(np.asarray(ig, dtype=np.float64), lower, upper)
+
+    norm_sq, jtj, jtr = normal_equations(param)
+    nfev, njev = 0, 1
+    # The damping is relative to the diagonal, which scales the system.
+    damping = 1.0E-3
+    factor = 2.0
+    success = False
+    message = 'The maximum number of iterations has been reached.'
+
+    for n_iter in xrange(0, max_iter):
+
+        scale = np.maximum(np.diag(jtj), 1.0E-12 * np.max(np.diag(jtj)))
+        free = ~(
+                ((param <= lower) & (jtr > 0))
+                | ((param >= upper) & (jtr < 0))
+                )
+        step = np.zeros(len(param), dtype=np.float64)
+        try:
+            step[free] = np.linalg.solve(
+                    jtj[np.ix_(free, free)] + damping * np.diag(scale[free]),
+                    -jtr[free]
+                    )
+        except np.linalg.LinAlgError:
+            damping *= factor
+            factor *= 2.0
+            continue
+        step = np.clip(param + step, lower, upper) - param
+
+        if np.linalg.norm(step) <= tol * (np.linalg.norm(param) + tol):
+            success = True
+            message = 'The change of the parameters is within the tolerance.'
+            break
+
+        new_res = residue(param + step)
+        new_norm_sq = new_res.dot(new_res)
+        nfev += 1
+
+        # The decrease predicted by the linear model of the residue
+        predicted = -(2.0 * step.dot(jtr) + step.dot(jtj.dot(step)))
+        ratio = (norm_sq - new_norm_sq) / predicted if predicted > 0 else -1.0
+
+        if ratio > 0:
+            param = param + step
+            old_norm_sq = norm_sq
+            norm_sq, jtj, jtr = normal_equations(param)
+            njev += 1
+            damping *= max(1.0 / 3, 1.0 - (2.0 * ratio - 1.0) ** 3)
+            factor = 2.0
+            if callback is not None:
+                callback(n_iter, param)
+            if old_norm_sq - norm_sq <= tol * old_norm_sq:
+                success = True
+                message = 'The change of the residue is within the tolerance.'
+                break
+        else:
+            damping *= factor
+            factor *= 2.0
+        continue
+
+    return optimize.OptimizeResult(
+            x=param, success=success, status=int(success), message=message,
+            fun=norm_sq, nfev=nfev, njev=njev, nit=n_iter + 1
+            )
@@ -0,0 +1,43 @@
+"""Defines the pools of worker processes sharing the closures
+
+The residue and Jacobian closures hold the interactions of all the
+configurations, which are too costly to be pickled and sent to the workers.
+Instead they are put into a module-level dictionary before the pool is forked,
+so that the workers inherit them, and the dictionary is cleared once the pool
+is done.
+
+"""
+
+import multiprocessing
+import contextlib
+
+
+@contextlib.contextmanager
+def shared_pool(shared, values, jobs):
+
+    """Sets up a pool of workers sharing the given values by forking
+
+    :param dict shared: The module-level dictionary that the functions run by
+      the workers read the shared values from.
+    :param dict values: The values to be shared, like the closures and the
+      fitting options.
+    :param int jobs: The number of worker processes, with the functions run in
+      the current process when it is not more than one.
+    :return: The context manager giving the mapping function, which maps a
+      function over a list in the pool with each item dispatched on its own.
+
+    """
+
+    shared.update(values)
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+
+    try:
+        if pool is not None:
+            yield lambda func, items: pool.map(func, items, chunksize=1)
+        else:
+            yield map
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shared.clear()
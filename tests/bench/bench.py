@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""Benchmarks the phases of the fitting on synthetic data sets
+
+A synthetic data set is generated from a set of known Morse parameters, with
+configurable numbers of configurations, molecules in each configuration, atoms
+in each molecule and element types. Then the reading of the configuration
+files, the resolution of the interactions, the evaluation of the residue and
+the Jacobian, and the full fit are timed separately, and the timings are
+appended as a JSON line to the output file, so that the results can be
+compared over time.
+
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import itertools
+
+import numpy as np
+from scipy import optimize
+
+from morsefit.inputread import (
+        read_morse_inp, parse_configuration, read_configuration_set
+        )
+from morsefit.residue import gen_rj_func
+from morsefit.solvers import fit_trust_region
+
+
+def gen_dataset(dir_name, n_confs, n_mols, n_atoms, n_elems, seed):
+
+    """Generates the synthetic data set in a directory
+
+    The molecules are rigid random clusters of atoms, placed at random
+    positions and orientations in a box growing with the number of molecules.
+    The energies are computed from randomly drawn true Morse parameters over
+    all the intermolecular pairs, and the initial guesses are written into
+    ``morse.inp`` with the true values perturbed.
+
+    :return: The list of the configuration file names, and the array of true
+      parameters.
+
+    """
+
+    rand = np.random.RandomState(seed)
+    elems = [ 'E%d' % i for i in xrange(0, n_elems) ]
+    pairs = list(itertools.combinations_with_replacement(elems, 2))
+    true_params = np.column_stack((
+        rand.uniform(0.01, 0.1, len(pairs)),
+        rand.uniform(1.0, 2.0, len(pairs)),
+        rand.uniform(2.5, 3.5, len(pairs))
+        ))
+    pair_idx = dict((v, i) for i, v in enumerate(pairs))
+
+    with open(os.path.join(dir_name, 'morse.inp'), 'w') as morse_inp:
+        for pair, param in zip(pairs, true_params):
+            guess = param * rand.uniform(0.8, 1.2, 3)
+            print >> morse_inp, "%s %s %f %f %f 0.0 1.0 0.1 5.0 1.0 6.0" % (
+                    pair[0], pair[1], guess[0], guess[1], guess[2]
+                    )
+            continue
+
+    # The molecule template, with atoms about 1.5 apart
+    template = rand.normal(scale=1.5, size=(n_atoms, 3))
+    mol_elems = [ elems[rand.randint(n_elems)] for i in xrange(0, n_atoms) ]
+    box = 4.0 * n_atoms ** (1.0 / 3) * n_mols ** (1.0 / 3) + 3.0
+
+    file_names = []
+    for i_conf in xrange(0, n_confs):
+        mols = []
+        for i_mol in xrange(0, n_mols):
+            rot, _ = np.linalg.qr(rand.normal(size=(3, 3)))
+            mols.append(template.dot(rot) + rand.uniform(0, box, 3))
+            continue
+
+        energy = 0.0
+        for mol1, mol2 in itertools.combinations(xrange(0, n_mols), 2):
+            for a1, a2 in itertools.product(xrange(0, n_atoms), repeat=2):
+                de, a, r0 = true_params[pair_idx[tuple(sorted(
+                    (mol_elems[a1], mol_elems[a2])
+                    ))]]
+                r = np.linalg.norm(mols[mol1][a1] - mols[mol2][a2])
+                energy += de * ((np.exp(a * (r0 - r)) - 1.0) ** 2 - 1.0)
+                continue
+            continue
+
+        file_name = os.path.join(dir_name, 'conf-%06d' % i_conf)
+        with open(file_name, 'w') as conf_file:
+            print >> conf_file, "%25.12f" % energy
+            print >> conf_file, "synthetic-%d" % i_conf
+            for mol in mols:
+                print >> conf_file, ""
+                for symb, coord in zip(mol_elems, mol):
+                    print >> conf_file, " %s %20.12f %20.12f %20.12f " % (
+                            symb, coord[0], coord[1], coord[2]
+                            )
+                    continue
+                continue
+        file_names.append(file_name)
+        continue
+
+    return file_names, true_params.ravel()
+
+
+def time_phase(func, repeat):
+
+    """Times a function by the best of a number of repetitions
+
+    :return: The best wall time in seconds, and the result of the last call.
+
+    """
+
+    best = None
+    for i in xrange(0, repeat):
+        begin = time.time()
+        result = func()
+        elapsed = time.time() - begin
+        best = elapsed if best is None else min(best, elapsed)
+        continue
+    return best, result
+
+
+def calc_interactions(confs, cut_off):
+
+    """Calculates the interactions of the configurations from scratch"""
+
+    for i in confs:
+        i.interactions = []
+        i.calc_interactions(cut_off)
+        continue
+    return None
+
+
+def main():
+
+    """The main driver of the benchmarks"""
+
+    parser = argparse.ArgumentParser(
+            description='Benchmark the phases of the fitting'
+            )
+    parser.add_argument('-n', '--confs', default=200, type=int,
+                        help='The number of configurations')
+    parser.add_argument('-m', '--molecules', default=2, type=int,
+                        help='The number of molecules in each configuration')
+    parser.add_argument('-a', '--atoms', default=10, type=int,
+                        help='The number of atoms in each molecule')
+    parser.add_argument('-e', '--elements', default=2, type=int,
+                        help='The number of element types')
+    parser.add_argument('-c', '--cutoff', default=None, type=float,
+                        help='The cut-off for the interactions')
+    parser.add_argument('-r', '--repeat', default=3, type=int,
+                        help='The number of repetitions for the timings')
+    parser.add_argument('--fit-nfev', default=200, type=int,
+                        help='The maximum number of evaluations in the fits')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='The random seed for the data set')
+    parser.add_argument('-d', '--dir', default=None,
+                        help='The directory for the data set, a temporary '
+                             'directory is used and removed by default')
+    parser.add_argument('-o', '--output', default='bench.jsonl',
+                        help='The file to append the results to')
+    args = parser.parse_args()
+
+    dir_name = args.dir if args.dir is not None else tempfile.mkdtemp()
+    if not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+
+    try:
+        timings = {}
+
+        timings['generate'], (file_names, true_params) = time_phase(
+                lambda: gen_dataset(
+                    dir_name, args.confs, args.molecules, args.atoms,
+                    args.elements, args.seed
+                    ), 1
+                )
+        with open(os.path.join(dir_name, 'morse.inp')) as morse_inp:
+            morse_guess = read_morse_inp(morse_inp)
+        ig = np.array([ j for i in morse_guess for j in i[1] ])
+        bounds = [
+                (i[2][j * 2], i[2][j * 2 + 1])
+                for i in morse_guess for j in xrange(0, 3)
+                ]
+
+        timings['parse_configuration'], confs = time_phase(
+                lambda: [ parse_configuration(i) for i in file_names ],
+                args.repeat
+                )
+        timings['calc_interactions'], _ = time_phase(
+                lambda: calc_interactions(confs, args.cutoff), args.repeat
+                )
+        timings['read_configuration_set'], conf_set = time_phase(
+                lambda: read_configuration_set(file_names, args.cutoff),
+                args.repeat
+                )
+
+        timings['gen_rj_func'], (residue, jacobi) = time_phase(
+                lambda: gen_rj_func(conf_set, morse_guess), args.repeat
+                )
+        timings['residue'], _ = time_phase(lambda: residue(ig), args.repeat)
+        timings['jacobi'], _ = time_phase(lambda: jacobi(ig), args.repeat)
+
+        timings['fit_leastsq'], lma_result = time_phase(
+                lambda: optimize.leastsq(
+                    residue, ig, Dfun=jacobi, col_deriv=True,
+                    maxfev=args.fit_nfev, full_output=True
+                    ), 1
+                )
+        timings['fit_trf'], trf_result = time_phase(
+                lambda: fit_trust_region(
+                    residue, jacobi, ig, bounds, max_nfev=args.fit_nfev
+                    ), 1
+                )
+
+        record = {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'dataset': {
+                    'confs': args.confs,
+                    'molecules': args.molecules,
+                    'atoms': args.atoms,
+                    'elements': args.elements,
+                    'cutoff': args.cutoff,
+                    'seed': args.seed,
+                    'interactions': len(conf_set.dists)
+                    },
+                'repeat': args.repeat,
+                'timings': timings,
+                'fits': {
+                    'leastsq_nfev': lma_result[2]['nfev'],
+                    'leastsq_residue': float(np.linalg.norm(
+                        residue(lma_result[0])
+                        )),
+                    'trf_nfev': trf_result.nfev,
+                    'trf_residue': float(np.linalg.norm(trf_result.fun)),
+                    'trf_param_error': float(np.max(np.abs(
+                        trf_result.x - true_params
+                        )))
+                    }
+                }
+
+    finally:
+        if args.dir is None:
+            shutil.rmtree(dir_name)
+
+    with open(args.output, 'a') as output:
+        print >> output, json.dumps(record, sort_keys=True)
+
+    for k in sorted(timings.keys()):
+        print " %25s %15.6f " % (k, timings[k])
+        continue
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())